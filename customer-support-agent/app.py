@@ -1,22 +1,43 @@
 #!/usr/bin/env python3
 import streamlit as st
 from chatbot import ChatBot
+from clients import shared_client, warm_up
 from config import TASK_SPECIFIC_INSTRUCTIONS
+from context import ContextWindow, ModelSummarizer
+
+CONTEXT_TURNS = 8
+
+
+@st.cache_resource
+def anthropic_client():
+    """One client for every session and rerun, connected before the first message"""
+    client = shared_client()
+    warm_up(client)
+    return client
 
 
 def main():
     st.title("Chat with Eva, Acme Insurance Company's Assistant🤖")
 
     if "messages" not in st.session_state:
-        st.session_state.messages = [
-            {"role": "user", "content": TASK_SPECIFIC_INSTRUCTIONS},
-            {"role": "assistant", "content": "Understood"},
-        ]
-
-    chatbot = ChatBot(st.session_state)
-
-    # Display user and assistant messages skipping the first two
-    for message in st.session_state.messages[2:]:
+        st.session_state.messages = []
+
+    # kept across reruns, since it remembers what it has already summarized
+    if "context" not in st.session_state:
+        st.session_state.context = ContextWindow(
+            CONTEXT_TURNS, summarizer=ModelSummarizer(client=anthropic_client())
+        )
+
+    # the static context lives in the cached system prompt rather than the first turn
+    chatbot = ChatBot(
+        st.session_state,
+        client=anthropic_client(),
+        static_context=TASK_SPECIFIC_INSTRUCTIONS,
+        prompt_cache=True,
+        context=st.session_state.context,
+    )
+
+    for message in st.session_state.messages:
         # ignore tool use blocks
         if isinstance(message["content"], str):
             with st.chat_message(message["role"]):
@@ -26,10 +47,16 @@ def main():
         st.chat_message("user").markdown(user_msg)
 
         with st.chat_message("assistant"):
-            with st.spinner("Eva is thinking..."):
-                response_placeholder = st.empty()
-                full_response = chatbot.process_user_input(user_msg)
-                response_placeholder.markdown(full_response)
+            response_placeholder = st.empty()
+            response_placeholder.markdown("_Eva is thinking..._")
+
+            full_response = ""
+            for text in chatbot.process_user_input_stream(user_msg):
+                full_response += text
+                response_placeholder.markdown(full_response + "▌")
+            response_placeholder.markdown(full_response)
+
+        st.caption(f"Tokens: {chatbot.usage}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Runs simulations in lockstep through the Message Batches API.
+
+All sessions advance one turn at a time: every session's user simulator call
+goes out in one batch, then every agent call, then the follow-up calls of the
+sessions whose agent used a tool, another round for those whose follow-up did
+too. Each session's turn is `ChatBot.turn_steps`, the same loop the
+interactive runs go through; tools run locally between batches. Batches
+are billed at a discount and don't count against the interactive rate limits,
+at the cost of waiting for each batch to finish, so this suits overnight sweeps
+rather than watching a conversation unfold.
+
+`stub_server.py` serves the batch endpoints too, for trying this out offline.
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import httpx
+from anthropic.types import Message
+
+from chatbot import (
+    INITIAL_PROMPT,
+    ChatBot,
+    SessionState,
+    TokenUsage,
+    save_session,
+    user_simulation_params,
+)
+from clients import shared_client
+from config import MODEL, TASK_SPECIFIC_INSTRUCTIONS
+from context import ContextWindow
+from prescreen import Prescreen
+from session_store import BATCH_ROWS, SessionWriter, to_jsonable
+from tool_cache import ToolCache
+
+BATCHES_BETA = "message-batches-2024-09-24"
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+
+# The API's limit on requests per batch
+MAX_BATCH_REQUESTS = 10_000
+
+
+class MessageBatches:
+    """Submits requests as message batches and waits for their results"""
+
+    def __init__(self, client=None, poll_interval=30.0, prompt_cache=False):
+        self.client = client or shared_client()
+        self.poll_interval = poll_interval
+        betas = [BATCHES_BETA, PROMPT_CACHING_BETA] if prompt_cache else [BATCHES_BETA]
+        self.headers = {"anthropic-beta": ",".join(betas)}
+
+    def request(self, method, path, body=None):
+        options = {"headers": self.headers}
+        if method == "post":
+            return self.client.post(path, body=body, cast_to=httpx.Response, options=options)
+        return self.client.get(path, cast_to=httpx.Response, options=options)
+
+    def submit(self, requests):
+        """Creates a batch of `{"custom_id": ..., "params": ...}` requests, returns the batch"""
+        return self.request("post", "/v1/messages/batches", {"requests": requests}).json()
+
+    def wait(self, batch):
+        while batch["processing_status"] != "ended":
+            time.sleep(self.poll_interval)
+            batch = self.request("get", f"/v1/messages/batches/{batch['id']}").json()
+        return batch
+
+    def results(self, batch):
+        """Maps each `custom_id` to its result: `succeeded` with a `message`, or not"""
+        response = self.request("get", batch["results_url"])
+        results = {}
+        for line in response.text.splitlines():
+            if line.strip():
+                result = json.loads(line)
+                results[result["custom_id"]] = result["result"]
+        return results
+
+    def run(self, requests):
+        """Submits `requests` in as few batches as allowed and returns all their results"""
+        batches = [
+            self.submit(requests[start : start + MAX_BATCH_REQUESTS])
+            for start in range(0, len(requests), MAX_BATCH_REQUESTS)
+        ]
+        results = {}
+        for batch in batches:
+            results.update(self.results(self.wait(batch)))
+        return results
+
+
+def result_message(result):
+    if result["type"] != "succeeded":
+        error = result.get("error", {}).get("error", {}).get("message", result["type"])
+        return {"error": error}
+    return Message.model_validate(result["message"])
+
+
+class BatchSession:
+    """One simulated conversation, advanced a phase at a time by `BatchSimulation`"""
+
+    def __init__(self, custom_id, chatbot):
+        self.custom_id = custom_id
+        self.chatbot = chatbot
+        self.assistant_response = None
+        self.steps = None  # the turn in progress, a `ChatBot.turn_steps`
+        self.step = None  # what it waits on, None between turns
+        self.done = False
+
+    @property
+    def messages(self):
+        return self.chatbot.session_state.messages
+
+    def waiting_on(self, kind):
+        return self.step is not None and self.step[0] == kind
+
+    def user_simulation_params(self):
+        return user_simulation_params(self.assistant_response)
+
+    def agent_params(self):
+        return {
+            "model": self.chatbot.model,
+            "system": self.chatbot.system,
+            "max_tokens": 2048,
+            "messages": to_jsonable(self.chatbot.request_messages(self.messages)),
+            "tools": self.chatbot.tools,
+        }
+
+    def user_replied(self, response):
+        if "error" in response or not response.content:
+            print("Error: Empty response from user simulation")
+            self.done = True
+            return
+        self.start_turn(response.content[0].text)
+
+    def start_turn(self, user_message):
+        self.steps = self.chatbot.turn_steps(user_message)
+        self.advance(None)
+
+    def advance(self, result):
+        """Answers the step the turn waits on, moving it to the next one or its end"""
+        try:
+            self.step = self.steps.send(result)
+        except StopIteration as stop:
+            self.steps, self.step = None, None
+            self.assistant_response = stop.value
+
+    def agent_replied(self, response):
+        if "error" not in response:
+            self.chatbot.usage.add(response.usage)
+        self.advance(response)
+
+    def run_tools(self):
+        _, tool_uses = self.step
+        return self.chatbot.run_tools(tool_uses)
+
+
+class BatchSimulation:
+    """Simulates `sessions` conversations of `num_turns` turns, one batch per phase"""
+
+    def __init__(
+        self,
+        sessions,
+        num_turns=10,
+        client=None,
+        poll_interval=30.0,
+        context_turns=None,
+        **chatbot_kwargs,
+    ):
+        client = client or shared_client()
+        self.num_turns = num_turns
+        self.batches = MessageBatches(
+            client, poll_interval, prompt_cache=chatbot_kwargs.get("prompt_cache", False)
+        )
+        self.sessions = [
+            BatchSession(
+                f"session-{index}",
+                ChatBot(
+                    SessionState(),
+                    client=client,
+                    context=ContextWindow(context_turns) if context_turns else None,
+                    **chatbot_kwargs,
+                ),
+            )
+            for index in range(sessions)
+        ]
+
+    def live(self):
+        return [session for session in self.sessions if not session.done]
+
+    def step(self, sessions, params, replied):
+        results = self.batches.run(
+            [{"custom_id": session.custom_id, "params": params(session)} for session in sessions]
+        )
+        for session in sessions:
+            replied(session, result_message(results[session.custom_id]))
+
+    def run_turn(self, turn):
+        if turn == 0:
+            for session in self.sessions:
+                session.start_turn(INITIAL_PROMPT)
+        else:
+            self.step(
+                self.live(), BatchSession.user_simulation_params, BatchSession.user_replied
+            )
+
+        # every agent call waiting goes in one batch, a follow-up to tool calls in the next
+        while True:
+            calling = [session for session in self.live() if session.waiting_on("tools")]
+            if calling:
+                # each session runs its own tools concurrently, and the sessions run side by side
+                with ThreadPoolExecutor(max_workers=min(32, len(calling))) as pool:
+                    tool_results = list(pool.map(BatchSession.run_tools, calling))
+                for session, results in zip(calling, tool_results):
+                    session.advance(results)
+
+            generating = [session for session in self.live() if session.waiting_on("generate")]
+            if not generating:
+                return
+            self.step(generating, BatchSession.agent_params, BatchSession.agent_replied)
+
+    def run(self):
+        for turn in range(self.num_turns):
+            started = time.monotonic()
+            self.run_turn(turn)
+            print(
+                f"turn {turn + 1}/{self.num_turns}: {len(self.live())} sessions"
+                f" in {time.monotonic() - started:.1f}s"
+            )
+            if not self.live():
+                break
+        return self.sessions
+
+    def usage(self):
+        usage = TokenUsage()
+        for session in self.sessions:
+            usage += session.chatbot.usage
+        return usage
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Batch Simulation",
+        description="Simulates support chats in lockstep through the Message Batches API",
+    )
+    parser.add_argument("output_folder")
+    parser.add_argument("-g", "--guard", action="store_true")
+    parser.add_argument("-n", "--sessions", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--format", choices=["arrow", "pickle"], default="arrow")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="seconds between polls")
+    parser.add_argument(
+        "--static-context",
+        action="store_true",
+        help="put TASK_SPECIFIC_INSTRUCTIONS in the system prompt, as the app does",
+    )
+    parser.add_argument("--prompt-cache", action="store_true")
+    parser.add_argument("--context-turns", type=int)
+    parser.add_argument("--tool-cache", nargs="?", const="memory", metavar="SQLITE_PATH")
+    parser.add_argument("--prescreen", choices=["block", "shadow"])
+    parser.add_argument("--salt", choices=["full", "lean"], default="full")
+    args = parser.parse_args()
+
+    tool_cache = None
+    if args.tool_cache:
+        tool_cache = ToolCache(path=None if args.tool_cache == "memory" else args.tool_cache)
+
+    simulation = BatchSimulation(
+        args.sessions,
+        num_turns=args.turns,
+        poll_interval=args.poll_interval,
+        context_turns=args.context_turns,
+        use_guardrails=args.guard,
+        static_context=TASK_SPECIFIC_INSTRUCTIONS if args.static_context else None,
+        prompt_cache=args.prompt_cache,
+        tool_cache=tool_cache,
+        prescreen=Prescreen(mode=args.prescreen) if args.prescreen else None,
+        salt=args.salt,
+    )
+    sessions = simulation.run()
+
+    if args.format == "arrow":
+        # every session is done by now, so they can all go in large batches
+        with SessionWriter(args.output_folder, BATCH_ROWS) as writer:
+            for session in sessions:
+                writer.write(str(uuid4()), session.messages, args.guard, session.chatbot.verdicts)
+        print("wrote", len(sessions), "sessions to", writer.path)
+    else:
+        for session in sessions:
+            save_session(args.output_folder, session.messages)
+        print("wrote", len(sessions), "sessions to", args.output_folder)
+
+    print(f"agent token usage (billed at the batch discount): {simulation.usage()}")
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Benchmarks for the agent's hot paths, run offline against `StubAnthropic`.
+
+Results go to `.benchmarks/<machine>/latest.json`. Once a baseline has been
+saved with `--save-baseline`, a run fails if any benchmark's fastest repeat got
+slower than the baseline's by more than `--threshold`. Timings only compare on
+the machine that made them, so baselines are kept per machine and out of git.
+"""
+import argparse
+import contextlib
+import io
+import json
+import pickle
+import platform
+import statistics
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+from anthropic.types import ToolUseBlock
+
+import config
+from chatbot import INITIAL_PROMPT, ChatBot, SessionState
+from analysis import analyze_folder
+from config import search, wrap_salt_mitigation
+from context import ContextWindow
+from session_store import SCHEMA, SessionWriter, flatten_session, read_part
+from stub_model import StubAnthropic
+
+RESULTS_DIR = Path(".benchmarks") / platform.node()
+DATA_DIR = Path(".benchmarks") / "data"
+BENCHMARKS = {}
+# closed after each benchmark, for what its setup leaves behind
+CLEANUP = contextlib.ExitStack()
+
+
+def benchmark(name):
+    """Registers a setup function that returns the callable to time"""
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def simulated_session(use_guardrails=False, num_turns=10):
+    chatbot = ChatBot(SessionState(), use_guardrails, client=StubAnthropic())
+    return chatbot.simulate_conversation(INITIAL_PROMPT, num_turns=num_turns)
+
+
+@benchmark("turn")
+def bench_turn():
+    chatbot = ChatBot(SessionState(), client=StubAnthropic())
+
+    def run():
+        chatbot.session_state.messages = []
+        chatbot.process_user_input(INITIAL_PROMPT)
+
+    return run
+
+
+@benchmark("turn_guarded")
+def bench_turn_guarded():
+    chatbot = ChatBot(SessionState(), use_guardrails=True, client=StubAnthropic())
+
+    def run():
+        chatbot.session_state.messages = []
+        chatbot.process_user_input(INITIAL_PROMPT)
+
+    return run
+
+
+@benchmark("tool_dispatch")
+def bench_tool_dispatch():
+    chatbot = ChatBot(SessionState(), client=StubAnthropic())
+    tool_uses = [
+        ToolUseBlock(type="tool_use", id="toolu_1", name="search", input={"q": "coverage"}),
+        ToolUseBlock(
+            type="tool_use",
+            id="toolu_2",
+            name="get_quote",
+            input={"make": "Honda", "model": "Civic", "year": 2019, "mileage": 1, "driver_age": 34},
+        ),
+    ]
+    return lambda: chatbot.run_tools(tool_uses)
+
+
+@benchmark("salt_wrap")
+def bench_salt_wrap():
+    results = f"Results from search: {search('coverage')}"
+    return lambda: wrap_salt_mitigation(results)
+
+
+@benchmark("context_window")
+def bench_context_window():
+    messages = simulated_session(num_turns=40)
+    return lambda: ContextWindow(max_turns=6)(messages)
+
+
+@benchmark("serialize_arrow")
+def bench_serialize_arrow():
+    messages = simulated_session()
+    folder = CLEANUP.enter_context(tempfile.TemporaryDirectory(prefix="bench-"))
+    writer = SessionWriter(folder)
+
+    def run():
+        writer.write("session", messages)
+        writer.flush()
+
+    return run
+
+
+@benchmark("serialize_pickle")
+def bench_serialize_pickle():
+    messages = simulated_session()
+    return lambda: pickle.dumps(messages)
+
+
+@benchmark("deserialize_arrow")
+def bench_deserialize_arrow():
+    folder = CLEANUP.enter_context(tempfile.TemporaryDirectory(prefix="bench-"))
+    with SessionWriter(folder) as writer:
+        messages = simulated_session()
+        for index in range(100):
+            writer.write(str(index), messages)
+    return lambda: read_part(writer.path)
+
+
+@benchmark("deserialize_pickle")
+def bench_deserialize_pickle():
+    data = [pickle.dumps(simulated_session()) for _ in range(100)]
+    return lambda: [pickle.loads(session) for session in data]
+
+
+def synthetic_folder(n_sessions, batch_sessions=10_000):
+    """Writes (once) a folder of `n_sessions` sessions, alternating baseline and guarded"""
+    folder = DATA_DIR / f"sessions-{n_sessions}"
+    if folder.exists():
+        return folder
+
+    templates = pa.Table.from_pylist(
+        flatten_session("baseline", simulated_session(False), False)
+        + flatten_session("guarded", simulated_session(True), True),
+        schema=SCHEMA,
+    )
+    within_pair = np.array([int(sid == "guarded") for sid in templates["session_id"].to_pylist()])
+    n_rows = len(templates)
+
+    folder.mkdir(parents=True)
+    with pa.ipc.new_stream(str(folder / "sessions-synthetic.arrows"), SCHEMA) as writer:
+        for start in range(0, n_sessions, batch_sessions):
+            n_pairs = min(batch_sessions, n_sessions - start) // 2
+            rows = templates.take(np.tile(np.arange(n_rows), n_pairs))
+            session_index = start + np.repeat(np.arange(n_pairs) * 2, n_rows) + np.tile(
+                within_pair, n_pairs
+            )
+            session_ids = pa.array(np.char.mod("%08d", session_index))
+            rows = rows.set_column(0, "session_id", session_ids.cast(pa.string()))
+            for batch in rows.to_batches():
+                writer.write_batch(batch)
+
+    return folder
+
+
+def analysis_benchmark(n_sessions):
+    def setup():
+        folder = synthetic_folder(n_sessions)
+        return lambda: analyze_folder(folder, workers=1)
+
+    return setup
+
+
+def measure(func, repeat):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [total / number for total in timer.repeat(repeat, number)]
+    return {"median": statistics.median(times), "min": min(times), "number": number}
+
+
+def compare(results, baseline, threshold):
+    # the fastest repeat is the least disturbed by whatever else the machine is doing
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result["min"] > baseline[name]["min"] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Benchmarks",
+        description="Times the agent's hot paths offline and checks them against a saved baseline",
+    )
+    parser.add_argument("-k", "--only", help="comma separated benchmark names to run")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="synthetic folder sizes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    # benchmark the code around the tools, not the pretend pricing backend
+    config.QUOTE_LATENCY = 0
+    for size in filter(None, args.sizes.split(",")):
+        BENCHMARKS[f"analyze_{size}"] = analysis_benchmark(int(size))
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+
+    results = {}
+    for name in names:
+        with CLEANUP, contextlib.redirect_stdout(io.StringIO()):
+            results[name] = measure(BENCHMARKS[name](), args.repeat)
+        median, fastest = results[name]["median"] * 1e3, results[name]["min"] * 1e3
+        print(f"{name:<22} {median:>12.4f} ms (min {fastest:.4f})")
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    (RESULTS_DIR / "latest.json").write_text(json.dumps(results, indent=2))
+
+    baseline_path = RESULTS_DIR / "baseline.json"
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2))
+        print("saved baseline to", baseline_path)
+    elif baseline_path.exists():
+        regressions = compare(results, json.loads(baseline_path.read_text()), args.threshold)
+        if regressions:
+            print("slower than the baseline:", ", ".join(regressions))
+            sys.exit(1)
+        print("no regressions against", baseline_path)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Write-ahead logs that let an interrupted simulation run pick up where it stopped.
+
+A run started with `chatbot.py --checkpoint` keeps its checkpoints in
+`<output folder>/.checkpoints/`:
+
+- `manifest.json`, the settings the run was started with, which a resumed run
+  must match
+- `finished.log`, the ids of the sessions already in the output folder, one per
+  line
+- `<session id>.wal`, one JSON line per completed turn of a session in
+  progress: the messages the turn added, its prescreen verdicts and the token
+  usage so far
+
+Every line is flushed and fsynced before the next turn starts, so a crash, a
+KeyboardInterrupt or a failed request loses at most the turn it happened in.
+A resumed run (`chatbot.py --resume`) restores each unfinished session from its
+log and only simulates the turns it's missing, and starts only as many new
+sessions as the run still lacks. The checkpoints are removed once every session
+of the run is written. A checkpointed run must be the only one writing to its
+folder; runs without checkpoints can share a folder as before.
+"""
+import json
+import os
+import shutil
+from pathlib import Path
+
+from prescreen import Verdict
+from session_store import load_messages, to_jsonable
+
+CHECKPOINT_DIR = ".checkpoints"
+
+
+def _append_line(file, record):
+    file.write(json.dumps(record) + "\n")
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def _read_lines(path):
+    """The JSON lines of `path` up to a last line cut short by a crash, and where they end"""
+    records, end = [], 0
+    if not path.exists():
+        return records, end
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            end += len(line)
+    return records, end
+
+
+def _open_to_append(path, end):
+    """Opens `path` to append lines after `end`, dropping a line cut short past it"""
+    file = open(path, "a")
+    file.truncate(end)
+    return file
+
+
+class SessionLog:
+    """The turns a session has completed so far, appended to `path` as they finish"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.turns, self._end = _read_lines(self.path)
+        self._logged_messages = sum(len(turn["messages"]) for turn in self.turns)
+        self._logged_verdicts = {
+            tool_use_id for turn in self.turns for tool_use_id in turn["verdicts"]
+        }
+        self._file = None
+
+    def restore(self, chatbot):
+        """Replays the logged turns into `chatbot`, returns the next turn and the last reply"""
+        for turn in self.turns:
+            chatbot.session_state.messages.extend(turn["messages"])
+            chatbot.verdicts.update(
+                {
+                    tool_use_id: Verdict(*verdict)
+                    for tool_use_id, verdict in turn["verdicts"].items()
+                }
+            )
+        if not self.turns:
+            return 0, None
+
+        last = self.turns[-1]
+        for field, value in last["usage"].items():
+            setattr(chatbot.usage, field, value)
+        return last["turn"] + 1, last["assistant_response"]
+
+    def append(self, turn, chatbot, assistant_response):
+        """Durably records everything `chatbot` did since the last logged turn"""
+        messages = chatbot.session_state.messages[self._logged_messages :]
+        verdicts = {
+            tool_use_id: [verdict.tool_name, verdict.rules, verdict.seconds]
+            for tool_use_id, verdict in chatbot.verdicts.items()
+            if tool_use_id not in self._logged_verdicts
+        }
+        record = {
+            "turn": turn,
+            "messages": to_jsonable(messages),
+            "verdicts": verdicts,
+            "usage": chatbot.usage.as_dict(),
+            "assistant_response": assistant_response,
+        }
+
+        if self._file is None:
+            self._file = _open_to_append(self.path, self._end)
+        _append_line(self._file, record)
+        self.turns.append(record)
+        self._logged_messages += len(messages)
+        self._logged_verdicts.update(verdicts)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class RunManifest:
+    """The checkpoints of the run writing to `output_folder`.
+
+    `config` holds the settings that shape a session (guard, turns, ...). With
+    `resume`, an existing manifest must have been written with the same ones;
+    without it, an unfinished run in the folder is an error rather than
+    something to silently mix new sessions into.
+    """
+
+    def __init__(self, output_folder, config, resume=False):
+        self.folder = Path(output_folder) / CHECKPOINT_DIR
+        self.manifest_path = self.folder / "manifest.json"
+        self.finished_path = self.folder / "finished.log"
+
+        if self.manifest_path.exists():
+            if not resume:
+                raise ValueError(
+                    f"{output_folder} has an unfinished run, pass --resume to continue it"
+                    f" or remove {self.folder}"
+                )
+            started_with = json.loads(self.manifest_path.read_text())
+            changed = {
+                key
+                for key in started_with.keys() | config.keys()
+                if started_with.get(key) != config.get(key)
+            }
+            if changed:
+                raise ValueError(
+                    f"can't resume a run started with different settings: {sorted(changed)}"
+                )
+        else:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            partial = self.manifest_path.with_suffix(".partial")
+            partial.write_text(json.dumps(config, indent=2))
+            os.replace(partial, self.manifest_path)
+
+        finished, end = _read_lines(self.finished_path)
+        self.finished = set(finished)
+        self._finished_file = _open_to_append(self.finished_path, end)
+
+    def unfinished(self):
+        """Ids of the sessions with logged turns that aren't in the output folder yet"""
+        return sorted(
+            path.stem for path in self.folder.glob("*.wal") if path.stem not in self.finished
+        )
+
+    def session_ids(self, sessions, new_id):
+        """The sessions still to run to reach `sessions`: unfinished ones first, then new ones"""
+        unfinished = self.unfinished()
+        remaining = max(0, sessions - len(self.finished))
+        resumed = unfinished[:remaining]
+        return resumed + [new_id() for _ in range(remaining - len(resumed))]
+
+    def recover(self, written):
+        """Marks the unfinished sessions among the `written` ids as finished.
+
+        A run that stopped between writing a session and marking it finished
+        would otherwise write it twice.
+        """
+        for session_id in set(self.unfinished()) & set(written):
+            self.finish(session_id, self.log(session_id))
+
+    def log(self, session_id):
+        return SessionLog(self.folder / f"{session_id}.wal")
+
+    def finish(self, session_id, log):
+        """Marks a session as written to the output folder and drops its log"""
+        log.close()
+        _append_line(self._finished_file, session_id)
+        self.finished.add(session_id)
+        log.path.unlink(missing_ok=True)
+
+    def close(self, complete=False):
+        """Closes the manifest, removing every checkpoint if the run is `complete`"""
+        self._finished_file.close()
+        if complete:
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def written_session_ids(output_folder, output_format="arrow"):
+    """Ids of the sessions already saved in `output_folder`"""
+    if output_format == "arrow":
+        return set(load_messages(output_folder, ["session_id"])["session_id"].to_pylist())
+    return {path.stem for path in Path(output_folder).glob("*.pkl")}
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Anthropic clients whose connections outlive a single chat turn.
+
+Every client owns an HTTP connection pool, so building one per `ChatBot` (or
+per Streamlit rerun) pays for a new TCP and TLS handshake on every user
+message. `shared_client` returns the one client the process reuses. Idle
+connections are kept alive for `KEEPALIVE_EXPIRY` seconds, long enough to span
+the pause while a user types, and `warm_up` opens them before the first turn.
+
+HTTP/2 multiplexes concurrent requests over one connection; it needs the `h2`
+package (`pip install httpx[http2]`) and is enabled with `ANTHROPIC_HTTP2=1`.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import httpx
+from anthropic import Anthropic, AsyncAnthropic, DefaultAsyncHttpxClient, DefaultHttpxClient
+
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY = 120.0
+HTTP2 = os.environ.get("ANTHROPIC_HTTP2", "") not in ("", "0")
+
+
+def connection_limits(
+    max_connections=MAX_CONNECTIONS,
+    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=KEEPALIVE_EXPIRY,
+):
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+
+def make_client(limits=None, http2=HTTP2, **client_kwargs):
+    """A new `Anthropic` client with its own tuned connection pool"""
+    http_client = DefaultHttpxClient(limits=limits or connection_limits(), http2=http2)
+    return Anthropic(http_client=http_client, **client_kwargs)
+
+
+def make_async_client(limits=None, http2=HTTP2, **client_kwargs):
+    """A new `AsyncAnthropic` client, for use on one event loop"""
+    http_client = DefaultAsyncHttpxClient(limits=limits or connection_limits(), http2=http2)
+    return AsyncAnthropic(http_client=http_client, **client_kwargs)
+
+
+@lru_cache(maxsize=None)
+def shared_client():
+    """The process-wide `Anthropic` client"""
+    return make_client()
+
+
+def warm_up(client, connections=1):
+    """Opens up to `connections` pooled connections to the API, returns the seconds taken.
+
+    Any answer will do, it's the connection (and TLS session) that's kept.
+    """
+    started = time.perf_counter()
+
+    def touch(_):
+        try:
+            client.with_options(max_retries=0).get("/v1/models", cast_to=httpx.Response)
+        except Exception:
+            pass
+
+    # concurrent requests can't share a connection, so each one opens its own
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        list(pool.map(touch, range(connections)))
+    return time.perf_counter() - started
+
+
+async def warm_up_async(client, connections=1):
+    """Same as `warm_up`, for an `AsyncAnthropic` client"""
+    started = time.perf_counter()
+
+    async def touch():
+        try:
+            await client.with_options(max_retries=0).get("/v1/models", cast_to=httpx.Response)
+        except Exception:
+            pass
+
+    await asyncio.gather(*(touch() for _ in range(connections)))
+    return time.perf_counter() - started
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Bounds the conversation history that is sent to the model.
+
+The full transcript stays in `session_state.messages`; `ContextWindow` only
+decides what each request carries: the last few turns verbatim, with everything
+before them folded into a rolling summary. History is only ever cut between
+turns, and a turn starts at a user text message, so a `tool_use` always travels
+with its matching `tool_result`.
+"""
+import json
+
+from clients import shared_client
+from config import MODEL
+
+SUMMARY_SYSTEM = """You summarize customer support conversations for the support agent that
+is continuing them. Keep every fact the agent may need later: the customer's
+name, email, location, vehicle details, quotes given, and open requests. Be brief."""
+
+
+def split_turns(messages):
+    """Groups messages into turns, each starting at a user message with text content"""
+    turns = []
+    for message in messages:
+        if not turns or (message["role"] == "user" and isinstance(message["content"], str)):
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _field(block, name):
+    if isinstance(block, dict):
+        return block.get(name)
+    return getattr(block, name, None)
+
+
+def render_transcript(messages, max_chars=None):
+    """Renders messages as plain `Role: text` lines, clipping each to `max_chars`"""
+
+    def clip(text):
+        text = " ".join(str(text).split())
+        if max_chars and len(text) > max_chars:
+            return text[:max_chars] + "…"
+        return text
+
+    lines = []
+    for message in messages:
+        role = message["role"].capitalize()
+        content = message["content"]
+        if isinstance(content, str):
+            lines.append(f"{role}: {clip(content)}")
+            continue
+
+        for block in content:
+            block_type = _field(block, "type")
+            if block_type == "text":
+                lines.append(f"{role}: {clip(_field(block, 'text'))}")
+            elif block_type == "tool_use":
+                params = json.dumps(_field(block, "input"), sort_keys=True)
+                lines.append(f"{role} called {_field(block, 'name')}({params})")
+            elif block_type == "tool_result":
+                lines.append(f"Tool result: {clip(_field(block, 'content'))}")
+
+    return "\n".join(lines)
+
+
+def extractive_summary(summary, messages, max_chars=2000):
+    """Appends a clipped transcript of `messages` to `summary`, keeping the newest text"""
+    summary = "\n".join(filter(None, [summary, render_transcript(messages, max_chars=160)]))
+    return summary[-max_chars:]
+
+
+class ModelSummarizer:
+    """Folds turns into the summary with a short model call"""
+
+    def __init__(self, client=None, model=MODEL, max_tokens=400):
+        self.anthropic = client or shared_client()
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def __call__(self, summary, messages):
+        prompt = (
+            f"<summary>\n{summary}\n</summary>\n\n"
+            f"<new_turns>\n{render_transcript(messages, max_chars=1000)}\n</new_turns>\n\n"
+            "Rewrite the summary so that it also covers the new turns."
+        )
+        response = self.anthropic.messages.create(
+            model=self.model,
+            system=SUMMARY_SYSTEM,
+            max_tokens=self.max_tokens,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        return response.content[0].text
+
+
+class ContextWindow:
+    """Keeps the last `max_turns` turns verbatim and summarizes the rest.
+
+    Tool results in earlier, already answered turns are clipped to
+    `stale_tool_result_chars`, or with 0, sent without their content. One instance belongs to
+    one conversation, since it remembers how much it has already summarized.
+    """
+
+    def __init__(self, max_turns=6, summarizer=extractive_summary, stale_tool_result_chars=200):
+        self.max_turns = max_turns
+        self.summarizer = summarizer
+        self.stale_tool_result_chars = stale_tool_result_chars
+        self.summary = ""
+        self._folded_turns = []
+
+    def __call__(self, messages):
+        turns = split_turns(messages)
+        older, recent = turns[: -self.max_turns], turns[-self.max_turns :]
+
+        if older[: len(self._folded_turns)] != self._folded_turns:
+            # a different (e.g. reset) conversation, start summarizing from scratch
+            self.summary = ""
+            self._folded_turns = []
+
+        if len(older) > len(self._folded_turns):
+            new_turns = older[len(self._folded_turns) :]
+            self.summary = self.summarizer(self.summary, [m for turn in new_turns for m in turn])
+            self._folded_turns = older
+
+        window = [self._clip_tool_results(m) for turn in recent[:-1] for m in turn]
+        window += recent[-1] if recent else []
+
+        if self.summary and window:
+            summary = f"<conversation_summary>\n{self.summary}\n</conversation_summary>"
+            first = window[0]
+            if isinstance(first["content"], str):
+                content = f"{summary}\n\n{first['content']}"
+            else:
+                content = [{"type": "text", "text": summary}, *first["content"]]
+            window[0] = {**first, "content": content}
+
+        return window
+
+    def _clip_tool_results(self, message):
+        if isinstance(message["content"], str):
+            return message
+
+        content = []
+        for block in message["content"]:
+            if _field(block, "type") == "tool_result" and not self.stale_tool_result_chars:
+                # a tool_result's content is optional
+                block = {key: value for key, value in block.items() if key != "content"}
+            elif _field(block, "type") == "tool_result":
+                text = str(_field(block, "content"))
+                if len(text) > self.stale_tool_result_chars:
+                    text = text[: self.stale_tool_result_chars] + "… [truncated, already answered]"
+                block = {**block, "content": text}
+            content.append(block)
+
+        return {**message, "content": content}
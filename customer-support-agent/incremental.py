@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Keeps the analysis of an append-only session store folder up to date.
+
+Simulation runs only ever add sessions: new part files, or new batches at the
+end of a part that's still being written. `IncrementalAnalysis` remembers, in
+`<folder>/.analysis/`, each part's size, modification time, a hash of its head
+and how many batches it has analyzed, along with the per-session results and
+their per-guard totals. An update scans only the batches it hasn't seen and
+adds their sessions to the totals; a part that was replaced rather than
+appended to is analyzed again from scratch.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from analysis import COLUMNS, INDICATORS, _merge, scan
+from session_store import part_files, read_batches
+
+CACHE_DIR = ".analysis"
+HEAD_BYTES = 64 * 1024
+
+
+def head_hash(path, size=HEAD_BYTES):
+    """Hashes the first `size` bytes of a file, which appending leaves alone"""
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(size), digest_size=16).hexdigest()
+
+
+def fingerprint(indicators, roles):
+    """Identifies what the cached results were computed with"""
+    return hashlib.blake2b(
+        json.dumps([indicators, list(roles)], sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+
+
+class IncrementalAnalysis:
+    """Cached `analysis.analyze_folder` results for `folder`, updated with `update()`"""
+
+    def __init__(self, folder, cache_dir=None, indicators=INDICATORS, roles=("assistant",)):
+        self.folder = Path(folder)
+        self.cache_dir = Path(cache_dir) if cache_dir else self.folder / CACHE_DIR
+        self.indicators = indicators
+        self.roles = tuple(roles)
+        self.manifest_path = self.cache_dir / "manifest.json"
+        self.sessions_path = self.cache_dir / "sessions.arrow"
+        self.load()
+
+    def load(self):
+        manifest = {}
+        if self.manifest_path.exists():
+            manifest = json.loads(self.manifest_path.read_text())
+        if manifest.get("fingerprint") != fingerprint(self.indicators, self.roles):
+            # indicators changed, or nothing is cached yet
+            manifest = {"fingerprint": fingerprint(self.indicators, self.roles), "files": {}}
+            self._sessions = None
+        self.manifest = manifest
+        self.manifest.setdefault("totals", {})
+
+    @property
+    def files(self):
+        return self.manifest["files"]
+
+    def sessions(self):
+        """One row per session, as `analyze_folder` returns (plus the `part` it came from)"""
+        if getattr(self, "_sessions", None) is None:
+            if self.sessions_path.exists() and self.files:
+                self._sessions = pd.read_feather(self.sessions_path).set_index("session_id")
+            else:
+                empty = _merge([], self.indicators).assign(part=pd.Series(dtype=str))
+                self._sessions = empty.rename_axis("session_id")
+        return self._sessions
+
+    def update(self):
+        """Analyzes what was added since the last update, returns how many sessions were new"""
+        sessions = self.sessions()
+        paths = part_files(self.folder)
+        new = []
+        stale = [name for name in self.files if name not in {path.name for path in paths}]
+        for name in stale:
+            del self.files[name]
+
+        for path in paths:
+            stat = path.stat()
+            seen = self.files.get(path.name)
+            if seen and (seen["size"], seen["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            # compare as many bytes as were hashed last time, the file may have grown since
+            appended = (
+                seen
+                and stat.st_size >= seen["size"]
+                and head_hash(path, seen["head_size"]) == seen["head_hash"]
+            )
+            if seen and not appended:
+                stale.append(path.name)
+            skip = seen["batches"] if appended else 0
+
+            batches = list(read_batches(path, COLUMNS, skip))
+            if batches:
+                table = pa.Table.from_batches(batches)
+                new.append(scan(table, self.indicators, self.roles).assign(part=path.name))
+            self.files[path.name] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "head_size": min(stat.st_size, HEAD_BYTES),
+                "head_hash": head_hash(path),
+                "batches": skip + len(batches),
+            }
+
+        if not new and not stale:
+            return 0
+
+        if stale:
+            sessions = sessions[~sessions["part"].isin(stale)]
+        added = _merge(new, self.indicators) if new else sessions.iloc[:0]
+
+        repeated = added.index.isin(sessions.index)
+        sessions = pd.concat([sessions, added])
+        call_columns = [column for column in sessions if column.startswith("calls_")]
+        sessions[call_columns] = sessions[call_columns].fillna(0).astype(np.int64)
+        if stale or repeated.any():
+            # some sessions were removed or continue in a new batch, total everything again
+            sessions = _combine(sessions, call_columns)
+            unused = [column for column in call_columns if not sessions[column].any()]
+            sessions = sessions.drop(columns=unused)
+            self.manifest["totals"] = totals(sessions, self.indicators)
+        else:
+            self.manifest["totals"] = add_totals(
+                self.manifest["totals"], totals(added, self.indicators)
+            )
+
+        self._sessions = sessions
+        self.save()
+        return len(added)
+
+    def save(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        sessions = self.sessions().reset_index()
+        sessions["session_id"] = sessions["session_id"].astype(str)
+        _replace(self.sessions_path, lambda path: sessions.to_feather(path))
+        _replace(self.manifest_path, lambda path: path.write_text(json.dumps(self.manifest)))
+
+    def summary(self):
+        """The `analysis.summarize` table, computed from the cached totals alone"""
+        rows = {}
+        for guard, total in self.manifest["totals"].items():
+            n = total["sessions"]
+            row = {"sessions": n, "hacked": total["hacked"]}
+            row.update({f"{name}_rate": total[name] / n for name in [*self.indicators, "hacked"]})
+            row.update({name: count for name, count in total.items() if name.startswith("calls_")})
+            rows[guard == "True"] = row
+
+        summary = pd.DataFrame.from_dict(rows, orient="index").fillna(0)
+        summary.index.name = "guard"
+        call_columns = [column for column in summary if column.startswith("calls_")]
+        summary[call_columns] = summary[call_columns].astype(np.int64)
+        return summary.sort_index()
+
+
+def _combine(sessions, call_columns):
+    return sessions.groupby(level=0).agg(
+        {column: "sum" if column in call_columns else ("last" if column == "part" else "max")
+         for column in sessions}
+    )
+
+
+def totals(sessions, indicators):
+    """Per-guard sums of sessions, indicator flags and tool calls"""
+    columns = [*indicators, "hacked", *[c for c in sessions if c.startswith("calls_")]]
+    grouped = sessions.groupby("guard")
+    sums = grouped[columns].sum()
+    return {
+        str(bool(guard)): {"sessions": int(size), **{c: int(sums.at[guard, c]) for c in columns}}
+        for guard, size in grouped.size().items()
+    }
+
+
+def add_totals(totals, more):
+    combined = {guard: dict(counts) for guard, counts in totals.items()}
+    for guard, counts in more.items():
+        into = combined.setdefault(guard, {})
+        for name, count in counts.items():
+            into[name] = into.get(name, 0) + count
+    return combined
+
+
+def _replace(path, write):
+    partial = path.with_name(path.name + ".partial")
+    write(partial)
+    os.replace(partial, path)
+
+
+def analyze_incremental(folder, **kwargs):
+    """Brings the cache of `folder` up to date and returns its summary"""
+    analysis = IncrementalAnalysis(folder, **kwargs)
+    analysis.update()
+    return analysis.summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Incremental Analysis",
+        description="Analyzes only the sessions added to session store folders since the last run",
+    )
+    parser.add_argument("folders", nargs="+")
+    parser.add_argument("--rebuild", action="store_true", help="discard the cache first")
+    args = parser.parse_args()
+
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        for folder in args.folders:
+            started = time.perf_counter()
+            analysis = IncrementalAnalysis(folder)
+            if args.rebuild:
+                analysis.manifest["files"] = {}
+                analysis.manifest["totals"] = {}
+                analysis._sessions = None
+            added = analysis.update()
+            elapsed = time.perf_counter() - started
+            print(f"{folder}: {added} new sessions analyzed in {elapsed:.3f}s")
+            print(analysis.summary())
+            print()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""Load-tests the chat with many concurrent, scripted users.
+
+Every virtual user opens a session and sends `SCRIPT` one message at a time,
+waiting for each reply. The target is one of:
+
+- `app`, the running Streamlit app (`make run`), driven over the websocket its
+  browser client uses, so every message costs a full rerun: a new `ChatBot`,
+  the whole history rendered again and the streamed reply
+- `chatbot`, `ChatBot.process_user_input_stream` in this process, set up the
+  way `app.py` sets it up, one thread per user
+- `server`, `server.py` over HTTP
+
+Concurrency ramps up through `--levels`. Each level reports its throughput,
+the p50/p95/p99 time to a whole response (and to its first token, where the
+reply streams), failed turns and the serving process's RSS growth per open
+session; sessions stay open until the level ends so that they're all counted.
+With `--slo`, the ramp stops at the first level whose p95 exceeds it.
+
+The model is best a `stub_server.py` with the latency to test against. With
+`--stub`, one runs in this process for the `chatbot` target; start the app or
+server with `ANTHROPIC_BASE_URL` pointing at a stub of their own.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+import pandas as pd
+import psutil
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from tornado.websocket import websocket_connect
+
+from app import CONTEXT_TURNS
+from chatbot import INITIAL_PROMPT, ChatBot, SessionState
+from clients import MAX_KEEPALIVE_CONNECTIONS, connection_limits, make_client, warm_up
+from config import TASK_SPECIFIC_INSTRUCTIONS
+from context import ContextWindow, ModelSummarizer
+from stub_model import USER_REPLIES
+from stub_server import LatencyModel, serve_in_thread
+
+SCRIPT = [INITIAL_PROMPT, *USER_REPLIES]
+
+# what app.py shows while a reply streams
+CURSOR = "▌"
+
+
+def server_process(port):
+    """The process listening on `port`, or None if it can't be found"""
+    for connection in psutil.net_connections(kind="tcp"):
+        if connection.laddr and connection.laddr.port == port and connection.status == "LISTEN":
+            return psutil.Process(connection.pid) if connection.pid else None
+    return None
+
+
+class ChatBotTarget:
+    """`ChatBot`s in this process, each turn on a thread of its own"""
+
+    def __init__(self, concurrency):
+        self.client = make_client(
+            connection_limits(max_keepalive_connections=max(MAX_KEEPALIVE_CONNECTIONS, concurrency))
+        )
+        warm_up(self.client)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="user")
+        self.process = psutil.Process()
+
+    async def open(self):
+        return ChatBot(
+            SessionState(),
+            client=self.client,
+            static_context=TASK_SPECIFIC_INSTRUCTIONS,
+            prompt_cache=True,
+            context=ContextWindow(CONTEXT_TURNS, summarizer=ModelSummarizer(client=self.client)),
+        )
+
+    def _send(self, chatbot, message, started):
+        first_token = None
+        for text in chatbot.process_user_input_stream(message):
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            if text.startswith("An error occurred"):
+                raise RuntimeError(text)
+        return first_token
+
+    async def send(self, chatbot, message):
+        """Sends `message`, returns the seconds to the reply's first token"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self._send, chatbot, message, time.perf_counter()
+        )
+
+    async def close(self, chatbot):
+        pass
+
+    def rss(self):
+        return self.process.memory_info().rss
+
+    async def aclose(self):
+        self.executor.shutdown()
+        self.client.close()
+
+
+class AppSession:
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.chat_input_id = None
+
+
+class AppTarget:
+    """The Streamlit app at `url`, through its websocket protocol"""
+
+    def __init__(self, url, process=None):
+        self.url = url.rstrip("/").replace("http", "ws", 1) + "/_stcore/stream"
+        self.process = process
+
+    async def rerun(self, session, message=None):
+        request = BackMsg()
+        request.rerun_script.query_string = ""
+        request.rerun_script.page_script_hash = ""
+        if message is not None:
+            widget = request.rerun_script.widget_states.widgets.add()
+            widget.id = session.chat_input_id
+            widget.string_trigger_value.data = message
+        await session.websocket.write_message(request.SerializeToString(), binary=True)
+
+    async def finished(self, session, started):
+        """Reads until the rerun ends, returns the seconds to the first streamed text"""
+        first_token = None
+        while True:
+            raw = await session.websocket.read_message()
+            if raw is None:
+                raise ConnectionError("The app closed the connection")
+            message = ForwardMsg()
+            message.ParseFromString(raw)
+            kind = message.WhichOneof("type")
+            if kind == "script_finished":
+                return first_token
+            if kind != "delta" or message.delta.WhichOneof("type") != "new_element":
+                continue
+
+            element = message.delta.new_element
+            element_type = element.WhichOneof("type")
+            if element_type == "chat_input":
+                session.chat_input_id = element.chat_input.id
+            elif element_type == "exception":
+                raise RuntimeError(element.exception.message)
+            elif (
+                element_type == "markdown"
+                and first_token is None
+                and element.markdown.body.endswith(CURSOR)
+            ):
+                first_token = time.perf_counter() - started
+
+    async def open(self):
+        session = AppSession(await websocket_connect(self.url))
+        await self.rerun(session)
+        await self.finished(session, time.perf_counter())
+        if session.chat_input_id is None:
+            raise RuntimeError("The app didn't render a chat input")
+        return session
+
+    async def send(self, session, message):
+        started = time.perf_counter()
+        await self.rerun(session, message)
+        return await self.finished(session, started)
+
+    async def close(self, session):
+        session.websocket.close()
+
+    def rss(self):
+        return self.process.memory_info().rss if self.process else None
+
+    async def aclose(self):
+        pass
+
+
+class ServerTarget:
+    """`server.py` at `url`"""
+
+    def __init__(self, url, process=None):
+        self.client = httpx.AsyncClient(base_url=url, timeout=600)
+        self.process = process
+
+    async def open(self):
+        response = await self.client.post("/sessions", json={})
+        response.raise_for_status()
+        return response.json()["session_id"]
+
+    async def send(self, session_id, message):
+        response = await self.client.post(
+            f"/sessions/{session_id}/messages", json={"message": message}
+        )
+        response.raise_for_status()
+        return None
+
+    async def close(self, session_id):
+        await self.client.delete(f"/sessions/{session_id}")
+
+    def rss(self):
+        return self.process.memory_info().rss if self.process else None
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def percentiles(seconds):
+    if not seconds:
+        return [float("nan")] * 3
+    return list(np.percentile(seconds, [50, 95, 99]))
+
+
+async def run_level(target, concurrency, sessions_per_user, script):
+    """Runs `concurrency` users at once, returns the level's report row"""
+    responses, first_tokens, sessions = [], [], []
+    failures = 0
+
+    async def user():
+        nonlocal failures
+        for _ in range(sessions_per_user):
+            try:
+                session = await target.open()
+            except Exception as e:
+                failures += 1
+                print(f"couldn't open a session: {e!r}", file=sys.stderr)
+                continue
+            sessions.append(session)
+            for message in script:
+                started = time.perf_counter()
+                try:
+                    first_token = await target.send(session, message)
+                except Exception as e:
+                    failures += 1
+                    print(f"turn failed: {e!r}", file=sys.stderr)
+                    break
+                responses.append(time.perf_counter() - started)
+                if first_token is not None:
+                    first_tokens.append(first_token)
+
+    rss_before = target.rss()
+    started = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    rss_after = target.rss()
+    for session in sessions:
+        await target.close(session)
+
+    p50, p95, p99 = percentiles(responses)
+    first_p50, first_p95, first_p99 = percentiles(first_tokens)
+    rss_per_session = float("nan")
+    if rss_before is not None and sessions:
+        rss_per_session = (rss_after - rss_before) / len(sessions) / 1024
+    return {
+        "concurrency": concurrency,
+        "sessions": len(sessions),
+        "turns": len(responses),
+        "failures": failures,
+        "turns_per_second": len(responses) / elapsed,
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+        "first_token_p50": first_p50,
+        "first_token_p95": first_p95,
+        "first_token_p99": first_p99,
+        "rss_kib_per_session": rss_per_session,
+        "rss_mib": rss_after / 2**20 if rss_after is not None else float("nan"),
+    }
+
+
+async def ramp(target, levels, sessions_per_user, script, slo=None):
+    """Runs each level in turn, stopping after the first one over the `slo` p95"""
+    rows = []
+    try:
+        for concurrency in levels:
+            row = await run_level(target, concurrency, sessions_per_user, script)
+            rows.append(row)
+            print(
+                f"{concurrency} users: {row['turns_per_second']:.2f} turns/s,"
+                f" p95 {row['p95']:.2f}s, {row['failures']} failures",
+                file=sys.stderr,
+            )
+            if slo is not None and row["p95"] > slo:
+                break
+    finally:
+        await target.aclose()
+    return pd.DataFrame(rows).set_index("concurrency")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Load Test",
+        description="Ramps up concurrent scripted chats and reports throughput, latency and memory",
+    )
+    parser.add_argument("target", choices=["app", "chatbot", "server"])
+    parser.add_argument(
+        "--url", help="of the app or server, http://localhost:8501 and :8000 by default"
+    )
+    parser.add_argument(
+        "--server-pid", type=int, help="process to measure RSS of, found by its port otherwise"
+    )
+    parser.add_argument("--levels", nargs="+", type=int, default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--sessions-per-user", type=int, default=2)
+    parser.add_argument("--turns", type=int, default=len(SCRIPT), help="messages per session")
+    parser.add_argument("--slo", type=float, help="stop ramping once p95 exceeds these seconds")
+    parser.add_argument("--stub", action="store_true", help="run a stub model in this process")
+    parser.add_argument("--ttft", type=float, default=0.5, help="with --stub")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="with --stub")
+    parser.add_argument("--output", metavar="CSV_PATH")
+    args = parser.parse_args()
+
+    if args.stub:
+        if args.target != "chatbot":
+            parser.error("--stub only serves the chatbot target, start the app against a stub_server.py")
+        stub = serve_in_thread(
+            latency=LatencyModel(ttft=args.ttft, tokens_per_second=args.tokens_per_second)
+        )
+        os.environ["ANTHROPIC_BASE_URL"] = stub.base_url
+        os.environ.setdefault("ANTHROPIC_API_KEY", "stub")
+
+    if args.target == "chatbot":
+        target = ChatBotTarget(max(args.levels))
+    else:
+        url = args.url or ("http://localhost:8501" if args.target == "app" else "http://localhost:8000")
+        process = (
+            psutil.Process(args.server_pid)
+            if args.server_pid
+            else server_process(httpx.URL(url).port)
+        )
+        if process is None:
+            print("couldn't find the server process, pass --server-pid for RSS", file=sys.stderr)
+        target = (AppTarget if args.target == "app" else ServerTarget)(url, process)
+
+    script = (SCRIPT * args.turns)[: args.turns]
+    results = asyncio.run(ramp(target, args.levels, args.sessions_per_user, script, args.slo))
+    if args.output:
+        results.to_csv(args.output)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(results.round(3))
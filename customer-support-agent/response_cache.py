@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Records Messages API responses, to replay experiments offline.
+
+Responses are stored in a SQLite file under a hash of everything that decides
+them: model, system prompt, tools, messages, `max_tokens` and the sampling
+parameters. UUIDs are masked before hashing, since the salt puts a fresh one
+around every guarded search result; everything else in a replayed session
+(tool use ids, the simulated user's replies) comes from the recorded responses,
+so a replay asks exactly the recorded questions.
+
+Identical requests are separate samples: every session starts with the same
+one, and a simulation is only worth as much as its sessions are independent.
+So a key is the hash plus the request's occurrence, the n-th identical request
+recorded gets the n-th key and the n-th identical request replayed gets its
+response back.
+
+A `ResponseCache` works in one of three modes:
+
+- `record` makes every call and records its response after those already in
+  the file
+- `replay` only answers from the file, and raises `ResponseCacheMiss` once a
+  request has been asked more often than it was recorded
+- `passthrough` leaves every call alone
+
+The file is kept under `max_bytes` by evicting the least recently used
+responses. Streamed calls (`process_user_input_stream`, the app) and context
+summaries aren't cached.
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from anthropic.types import Message
+from anthropic.types.beta.prompt_caching import PromptCachingBetaMessage
+
+from session_store import to_jsonable
+
+MODES = ("record", "replay", "passthrough")
+
+KEY_PARAMS = (
+    "model",
+    "system",
+    "tools",
+    "messages",
+    "max_tokens",
+    "temperature",
+    "top_p",
+    "top_k",
+    "stop_sequences",
+    "tool_choice",
+)
+
+UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+# The response types a cached response is rebuilt as, by name
+RESPONSE_TYPES = {cls.__name__: cls for cls in (Message, PromptCachingBetaMessage)}
+
+
+class ResponseCacheMiss(Exception):
+    """A `replay` found no recorded response for a request"""
+
+
+def request_key(params):
+    """A stable hash of the parts of `params` that decide the response, without its occurrence"""
+    request = {name: params[name] for name in KEY_PARAMS if params.get(name) is not None}
+    request["messages"] = to_jsonable(request["messages"])
+    text = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.blake2b(UUID.sub("<uuid>", text).encode(), digest_size=20).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, mode="record", max_bytes=1 << 30):
+        if mode not in MODES:
+            raise ValueError(f"Unknown response cache mode: {mode}")
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, type TEXT, value TEXT, size INTEGER, accessed_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS lru ON responses (accessed_at)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        # request key -> occurrences replayed, or the next occurrence to record
+        self._occurrences = {}
+
+    def _next_occurrence(self, key):
+        if key not in self._occurrences:
+            self._occurrences[key] = 0
+            if self.mode == "record":
+                # after the occurrences earlier runs recorded
+                last = self._db.execute(
+                    "SELECT MAX(CAST(substr(key, ?) AS INTEGER)) FROM responses"
+                    " WHERE key > ? AND key < ?",
+                    (len(key) + 2, f"{key}:", f"{key};"),
+                ).fetchone()[0]
+                self._occurrences[key] = 0 if last is None else last + 1
+        occurrence = self._occurrences[key]
+        self._occurrences[key] += 1
+        return f"{key}:{occurrence}"
+
+    def lookup(self, params):
+        """The recorded response to this occurrence of `params` when replaying, otherwise None"""
+        if self.mode != "replay":
+            return None
+
+        with self._lock:
+            key = self._next_occurrence(request_key(params))
+            row = self._db.execute(
+                "SELECT type, value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key)
+                )
+            self.counts["hits" if row else "misses"] += 1
+
+        if row is None:
+            raise ResponseCacheMiss(f"No recorded response for request {key}")
+        response_type, value = row
+        return RESPONSE_TYPES[response_type].model_validate_json(value)
+
+    def store(self, params, response):
+        """Records `response` to `params` (in `record` mode)"""
+        if self.mode != "record":
+            return
+
+        value = response.model_dump_json()
+        with self._lock:
+            key = self._next_occurrence(request_key(params))
+            replaced = self._db.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, type(response).__name__, value, len(value), time.time()),
+            )
+            self._size += len(value) - (replaced[0] if replaced else 0)
+            self.counts["stored"] += 1
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            oldest = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at LIMIT 100"
+            ).fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if self._size <= self.max_bytes:
+                    break
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                self.counts["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self.counts, "bytes": self._size}
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Compares the full salt wrapper with the lean one, on cost and on defense.
+
+Runs the same number of guarded sessions with each wrapper (and, with
+`--baseline`, unguarded ones for reference) into `<output_folder>/<arm>`, then
+reports per arm the prompt tokens per session, how many of them were read from
+the cache, and the share of sessions the injection got through. The lean salt
+only pays off if its hacked rate stays where the full salt's is.
+"""
+import argparse
+import asyncio
+from pathlib import Path
+
+import pandas as pd
+
+from analysis import analyze_folder
+from chatbot import run_sessions
+from config import TASK_SPECIFIC_INSTRUCTIONS
+from scheduler import AsyncScheduler
+
+ARMS = {
+    "baseline": {"use_guardrails": False},
+    "full": {"use_guardrails": True, "salt": "full"},
+    "lean": {"use_guardrails": True, "salt": "lean"},
+}
+
+
+def run_arm(folder, arm, sessions, concurrency, num_turns, **chatbot_kwargs):
+    """Runs one arm's sessions into `folder`, returns their combined `TokenUsage`"""
+    return asyncio.run(
+        run_sessions(
+            folder,
+            sessions=sessions,
+            concurrency=concurrency,
+            num_turns=num_turns,
+            scheduler=AsyncScheduler(max_concurrency=max(1, concurrency)),
+            **ARMS[arm],
+            **chatbot_kwargs,
+        )
+    )
+
+
+def arm_report(folder, usage):
+    sessions = analyze_folder(folder)
+    n = max(1, len(sessions))
+    prompt_tokens = (
+        usage.input_tokens + usage.cache_creation_input_tokens + usage.cache_read_input_tokens
+    )
+    return {
+        "sessions": len(sessions),
+        "prompt_tokens_per_session": prompt_tokens / n,
+        "input_tokens_per_session": usage.input_tokens / n,
+        "cache_read_tokens_per_session": usage.cache_read_input_tokens / n,
+        "output_tokens_per_session": usage.output_tokens / n,
+        "hacked_rate": sessions["hacked"].mean() if len(sessions) else float("nan"),
+    }
+
+
+def compare(output_folder, arms, sessions, concurrency, num_turns, **chatbot_kwargs):
+    """Runs every arm and returns the report, one row per arm"""
+    rows = {}
+    for arm in arms:
+        folder = Path(output_folder) / arm
+        usage = run_arm(folder, arm, sessions, concurrency, num_turns, **chatbot_kwargs)
+        rows[arm] = arm_report(folder, usage)
+
+    report = pd.DataFrame.from_dict(rows, orient="index")
+    if "full" in rows and "lean" in rows:
+        report["prompt_tokens_vs_full"] = (
+            report["prompt_tokens_per_session"] / rows["full"]["prompt_tokens_per_session"]
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Salt A/B",
+        description="Measures tokens per session and injection success with the full and lean salt",
+    )
+    parser.add_argument("output_folder", help="a new folder, each arm writes to a subfolder")
+    parser.add_argument("-n", "--sessions", type=int, default=20, help="sessions per arm")
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--baseline", action="store_true", help="also run unguarded sessions")
+    parser.add_argument(
+        "--no-prompt-cache",
+        action="store_true",
+        help="send the system prompt uncached, which the lean salt's instructions are part of",
+    )
+    args = parser.parse_args()
+
+    if Path(args.output_folder).exists() and any(Path(args.output_folder).iterdir()):
+        parser.error(f"{args.output_folder} isn't empty")
+
+    report = compare(
+        args.output_folder,
+        ["baseline", "full", "lean"] if args.baseline else ["full", "lean"],
+        args.sessions,
+        args.concurrency,
+        args.turns,
+        static_context=TASK_SPECIFIC_INSTRUCTIONS,
+        prompt_cache=not args.no_prompt_cache,
+    )
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(report)
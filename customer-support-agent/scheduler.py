@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""Paces Messages API calls to the account's rate limits, and retries the ones that hit them.
+
+A `Scheduler` sits between a `ChatBot` and its client. Before a request goes
+out it takes its share of three token buckets, requests, input tokens and
+output tokens per minute, waiting until they refill if need be. The buckets
+start from the configured limits (if any) and follow the `anthropic-ratelimit-*`
+headers of every response. Rate limit (429), overloaded (529) and other
+transient errors are retried after `retry-after`, or a jittered exponential
+backoff, and the number of requests allowed in flight adapts AIMD-style:
+it starts at the concurrency asked for, halves on a rate limit and grows
+back by about one per round of successes.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import anthropic
+
+# Headers the API reports each limit in, as `<prefix>-limit` and `<prefix>-remaining`
+RATE_LIMIT_HEADERS = {
+    "requests": "anthropic-ratelimit-requests",
+    "input_tokens": "anthropic-ratelimit-input-tokens",
+    "output_tokens": "anthropic-ratelimit-output-tokens",
+}
+
+
+class TokenBucket:
+    """Allows `limit` units per minute, in bursts of up to `limit`.
+
+    An unknown (`None`) limit lets everything through until a response
+    reports one.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.tokens = float(limit or 0)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.limit:
+            rate = self.limit / 60
+            self.tokens = min(self.limit, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Takes `amount`, returns the seconds to wait until it's actually available"""
+        self.refill(now)
+        if not self.limit:
+            return 0.0
+        # a request bigger than the whole bucket waits for a full one
+        self.tokens -= min(amount, self.limit)
+        return max(0.0, -self.tokens / (self.limit / 60))
+
+    def give_back(self, amount):
+        if self.limit:
+            self.tokens = min(self.limit, self.tokens + amount)
+
+    def update(self, limit, remaining, now):
+        """Follows what the API reports, which also counts other clients' requests"""
+        self.refill(now)
+        if limit:
+            self.limit = limit
+        if remaining is not None and self.limit:
+            self.tokens = min(self.tokens, remaining)
+
+
+def _header_number(headers, name):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def retry_after(headers):
+    """Seconds to wait according to `retry-after`, or None"""
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        # an HTTP date
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    try:
+        # or the RFC 3339 timestamps of the rate limit `reset` headers
+        return max(0.0, datetime.fromisoformat(value).timestamp() - time.time())
+    except ValueError:
+        return None
+
+
+def estimate_input_tokens(params):
+    """A cheap overestimate, about four characters per token"""
+    return (
+        len(str(params.get("system", "")))
+        + len(str(params.get("tools", "")))
+        + len(str(params.get("messages", "")))
+    ) // 4 + 1
+
+
+def is_retryable(error):
+    if isinstance(error, (anthropic.APIConnectionError, anthropic.APITimeoutError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+class Scheduler:
+    """Calls `resource.create(**params)` within the rate limits, retrying transient errors.
+
+    Any client a scheduler drives should be made with `max_retries=0`, so that
+    every retry goes through here.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=None,
+        input_tokens_per_minute=None,
+        output_tokens_per_minute=None,
+        max_concurrency=64,
+        initial_concurrency=None,
+        max_retries=8,
+        base_delay=1.0,
+        max_delay=60.0,
+        seed=None,
+    ):
+        self.buckets = {
+            "requests": TokenBucket(requests_per_minute),
+            "input_tokens": TokenBucket(input_tokens_per_minute),
+            "output_tokens": TokenBucket(output_tokens_per_minute),
+        }
+        self.max_concurrency = max_concurrency
+        # all of `max_concurrency` unless told otherwise, backing off only once rate limited
+        if initial_concurrency is None:
+            initial_concurrency = max_concurrency
+        self.concurrency = float(min(initial_concurrency, max_concurrency))
+        self.in_flight = 0
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counts = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+        self._last_decrease = 0.0
+
+    def call(self, resource, **params):
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                time.sleep(self._reserve(params))
+                raw = resource.with_raw_response.create(**params)
+                response = raw.parse()
+            except Exception as error:
+                delay = self._failed(error, attempt)
+            else:
+                self._succeeded(raw.headers, params, response.usage)
+                return response
+            finally:
+                # also when `_failed` gives up and raises, or the slot would be lost for good
+                self._release()
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {**self.counts, "concurrency": round(self.concurrency, 1)}
+
+    def _acquire(self):
+        with self._slots:
+            self._slots.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+
+    def _release(self):
+        with self._slots:
+            self.in_flight -= 1
+            self._slots.notify_all()
+
+    def _reserve(self, params):
+        now = time.monotonic()
+        with self._lock:
+            return max(
+                self.buckets["requests"].reserve(1, now),
+                self.buckets["input_tokens"].reserve(estimate_input_tokens(params), now),
+                self.buckets["output_tokens"].reserve(params.get("max_tokens", 0), now),
+            )
+
+    def _succeeded(self, headers, params, usage):
+        now = time.monotonic()
+        with self._lock:
+            self.counts["requests"] += 1
+            # settle the estimates against what the request actually used
+            used = usage.input_tokens + (getattr(usage, "cache_creation_input_tokens", 0) or 0)
+            self.buckets["input_tokens"].give_back(estimate_input_tokens(params) - used)
+            self.buckets["output_tokens"].give_back(
+                params.get("max_tokens", 0) - usage.output_tokens
+            )
+            for name, prefix in RATE_LIMIT_HEADERS.items():
+                self.buckets[name].update(
+                    _header_number(headers, f"{prefix}-limit"),
+                    _header_number(headers, f"{prefix}-remaining"),
+                    now,
+                )
+            # additive increase: about one more slot per `concurrency` successes
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def _failed(self, error, attempt):
+        """Returns the seconds to wait before retrying `error`, or raises it"""
+        if not is_retryable(error) or attempt == self.max_retries:
+            with self._lock:
+                self.counts["errors"] += 1
+            raise error
+
+        headers = error.response.headers if isinstance(error, anthropic.APIStatusError) else {}
+        status = getattr(error, "status_code", None)
+        now = time.monotonic()
+        with self._lock:
+            self.counts["retries"] += 1
+            if status == 429:
+                self.counts["rate_limited"] += 1
+            elif status == 529:
+                self.counts["overloaded"] += 1
+            # multiplicative decrease, once per burst of errors
+            if status in (429, 529) and now - self._last_decrease > 1.0:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self._last_decrease = now
+            backoff = self._random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+        waited = retry_after(headers)
+        return backoff if waited is None else waited + self._random.uniform(0, self.base_delay)
+
+
+class AsyncScheduler(Scheduler):
+    """Same as `Scheduler`, for the resources of an `AsyncAnthropic` client on one event loop"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_slots = None
+
+    async def call(self, resource, **params):
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_async()
+            try:
+                await asyncio.sleep(self._reserve(params))
+                raw = await resource.with_raw_response.create(**params)
+                response = raw.parse()
+            except Exception as error:
+                delay = self._failed(error, attempt)
+            else:
+                self._succeeded(raw.headers, params, response.usage)
+                return response
+            finally:
+                await self._release_async()
+            await asyncio.sleep(delay)
+
+    async def _acquire_async(self):
+        if self._async_slots is None:
+            self._async_slots = asyncio.Condition()
+        async with self._async_slots:
+            await self._async_slots.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+
+    async def _release_async(self):
+        async with self._async_slots:
+            self.in_flight -= 1
+            self._async_slots.notify_all()
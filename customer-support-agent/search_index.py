@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""A BM25 index over support tickets, for `config.search` to retrieve from.
+
+Tickets are read from JSONL, one `{"id": ..., "text": ...}` object per line
+(`subject` and `body` fields are joined when there's no `text`). Each ingest
+writes new immutable segments of numpy arrays next to a `manifest.json`, so
+appending never rebuilds what's already indexed, and opening an index only
+memory-maps files. Term statistics are combined across segments at query time.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+
+TOKEN = re.compile(r"[a-z0-9]+")
+# Terms are stored as fixed width bytes, longer ones are truncated
+MAX_TERM_BYTES = 32
+TERM_DTYPE = f"S{MAX_TERM_BYTES}"
+
+K1 = 1.2
+B = 0.75
+
+SEGMENT_DOCS = 100_000
+# The fraction of the corpus a query's postings must reach for it to be scored
+# into one array over every document
+DENSE_SCORING = 1 / 16
+SNIPPET_CHARS = 500
+
+
+def tokenize(text):
+    return [term[:MAX_TERM_BYTES] for term in TOKEN.findall(text.lower())]
+
+
+def read_tickets(path):
+    """Yields `(id, text)` for every ticket in a JSONL file"""
+    with open(path) as f:
+        for number, line in enumerate(f):
+            if not line.strip():
+                continue
+            ticket = json.loads(line)
+            text = ticket.get("text") or "\n".join(
+                filter(None, [ticket.get("subject"), ticket.get("body")])
+            )
+            yield str(ticket.get("id", f"{Path(path).stem}-{number}")), text
+
+
+def write_segment(folder, tickets):
+    """Writes the postings, document lengths and documents of `tickets` to `folder`"""
+    postings = defaultdict(list)
+    lengths = []
+    documents = []
+    for doc, (ticket_id, text) in enumerate(tickets):
+        counts = Counter(tokenize(text))
+        lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            postings[term].append((doc, tf))
+        documents.append(json.dumps({"id": ticket_id, "text": text}).encode())
+
+    terms = sorted(postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+    entries = [entry for term in terms for entry in postings[term]]
+    doc_offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+    doc_offsets[1:] = np.cumsum([len(document) for document in documents])
+
+    folder.mkdir(parents=True)
+    arrays = {
+        "terms": np.array([term.encode() for term in terms], dtype=TERM_DTYPE),
+        "offsets": offsets,
+        "docs": np.array([doc for doc, _ in entries], dtype=np.uint32),
+        "tfs": np.minimum([tf for _, tf in entries], np.iinfo(np.uint16).max).astype(np.uint16),
+        "lengths": np.array(lengths, dtype=np.uint32),
+        "doc_offsets": doc_offsets,
+    }
+    for name, array in arrays.items():
+        np.save(folder / f"{name}.npy", array)
+    (folder / "docs.bin").write_bytes(b"".join(documents))
+
+    return {"name": folder.name, "docs": len(lengths), "tokens": int(sum(lengths))}
+
+
+class Segment:
+    """One memory-mapped, immutable slice of the index"""
+
+    def __init__(self, folder):
+        def load(name):
+            return np.load(folder / f"{name}.npy", mmap_mode="r")
+
+        self.terms = load("terms")
+        self.offsets = load("offsets")
+        self.docs = load("docs")
+        self.tfs = load("tfs")
+        self.lengths = load("lengths")
+        self.doc_offsets = load("doc_offsets")
+        self.blob = np.memmap(folder / "docs.bin", dtype=np.uint8, mode="r")
+
+    def postings(self, term):
+        """Returns the `(docs, tfs)` containing `term`"""
+        key = term.encode()
+        i = np.searchsorted(self.terms, key)
+        if i == len(self.terms) or self.terms[i] != key:
+            return None
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.docs[start:stop], self.tfs[start:stop]
+
+    def document(self, doc):
+        start, stop = self.doc_offsets[doc], self.doc_offsets[doc + 1]
+        return json.loads(self.blob[start:stop].tobytes())
+
+
+class SearchIndex:
+    """Searches, and appends to, the index in `folder`"""
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.manifest_path = self.folder / "manifest.json"
+        self.segments = {}
+        self.manifest = {"segments": []}
+        self._mtime = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Picks up segments appended since the index was opened"""
+        try:
+            mtime = self.manifest_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            manifest = json.loads(self.manifest_path.read_text())
+            for entry in manifest["segments"]:
+                if entry["name"] not in self.segments:
+                    self.segments[entry["name"]] = Segment(self.folder / entry["name"])
+            self.manifest, self._mtime = manifest, mtime
+
+    @property
+    def n_docs(self):
+        return sum(entry["docs"] for entry in self.manifest["segments"])
+
+    def add(self, tickets, segment_docs=SEGMENT_DOCS):
+        """Indexes `(id, text)` pairs as new segments, returns how many were added"""
+        tickets = iter(tickets)
+        added = 0
+        while chunk := list(islice(tickets, segment_docs)):
+            entry = write_segment(self.folder / f"segment-{uuid4()}", chunk)
+            self._append(entry)
+            added += entry["docs"]
+        return added
+
+    def _append(self, entry):
+        # readers only see a segment once the manifest that lists it is in place
+        self.refresh()
+        manifest = {"segments": [*self.manifest["segments"], entry]}
+        partial = self.manifest_path.with_suffix(".json.partial")
+        partial.write_text(json.dumps(manifest, indent=2))
+        os.replace(partial, self.manifest_path)
+        self.refresh()
+
+    def search(self, q, k=3, budget=None):
+        """Returns up to `k` hits, best first, as dicts with `id`, `score` and `snippet`.
+
+        Only the documents matching a term are scored, so a query costs its
+        postings rather than the whole corpus. With a `budget` in seconds, the
+        rarest terms are scored first, and once it runs out the postings left,
+        those of the most common terms, are skipped.
+        """
+        self.refresh()
+        deadline = time.perf_counter() + budget if budget else None
+        entries = self.manifest["segments"]
+        n_docs = sum(entry["docs"] for entry in entries)
+        if not n_docs:
+            return []
+        avgdl = sum(entry["tokens"] for entry in entries) / n_docs
+        segments = [self.segments[entry["name"]] for entry in entries]
+        bases = np.cumsum([0] + [entry["docs"] for entry in entries]).tolist()
+
+        matches = {}
+        n_postings = 0
+        for term in dict.fromkeys(tokenize(q)):
+            found = [
+                (base, segment, segment.postings(term)) for base, segment in zip(bases, segments)
+            ]
+            found = [match for match in found if match[2] is not None]
+            df = sum(len(docs) for _, _, (docs, _) in found)
+            if df:
+                matches[term] = (np.log(1 + (n_docs - df + 0.5) / (df + 0.5)), found)
+                n_postings += df
+
+        if not matches:
+            return []
+
+        # one array over the corpus only when the postings are a good part of it,
+        # otherwise the matched documents alone, summed after sorting
+        dense = n_postings >= n_docs * DENSE_SCORING
+        scores = np.zeros(n_docs) if dense else None
+        doc_ids, contributions = [], []
+        postings = (
+            (idf, posting)
+            for idf, found in sorted(matches.values(), key=lambda m: -m[0])
+            for posting in found
+        )
+        for scored, (idf, (base, segment, (docs, tfs))) in enumerate(postings):
+            if deadline and scored and time.perf_counter() > deadline:
+                break
+            tfs = tfs.astype(np.float32)
+            norm = K1 * (1 - B + B * segment.lengths[docs] / avgdl)
+            contribution = idf * tfs * (K1 + 1) / (tfs + norm)
+            if dense:
+                np.add.at(scores[base : base + len(segment.lengths)], docs, contribution)
+            else:
+                doc_ids.append(docs.astype(np.int64) + base)
+                contributions.append(contribution)
+
+        if not dense:
+            keys, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+            scores = np.bincount(inverse, np.concatenate(contributions))
+
+        top = np.argpartition(-scores, k)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        top_scores = scores[top]
+        if not dense:
+            top = keys[top]
+
+        hits = []
+        for key, score in zip(top.tolist(), top_scores.tolist()):
+            if score <= 0:
+                break
+            segment_index = bisect_right(bases, key) - 1
+            document = segments[segment_index].document(key - bases[segment_index])
+            hits.append(
+                {
+                    "id": document["id"],
+                    "score": score,
+                    "snippet": snippet(document["text"], matches),
+                }
+            )
+        return hits
+
+
+def snippet(text, terms, max_chars=SNIPPET_CHARS):
+    """The part of `text` around the first of `terms` it contains"""
+    if len(text) <= max_chars:
+        return text
+    found = re.search("|".join(rf"\b{re.escape(term)}" for term in terms), text, re.IGNORECASE)
+    start = max(0, found.start() - max_chars // 5) if found else 0
+    clipped = text[start : start + max_chars]
+    return ("..." if start else "") + clipped + ("..." if start + max_chars < len(text) else "")
+
+
+@lru_cache(maxsize=None)
+def open_index(folder):
+    """Returns the one `SearchIndex` per folder that the process shares"""
+    return SearchIndex(folder)
+
+
+TOPICS = [
+    ("claim", "I was rear-ended at a stop light and need to file a collision claim."),
+    ("billing", "My premium went up this month and I don't understand the new charge."),
+    ("coverage", "Does my policy cover a rental car while mine is in the shop?"),
+    ("roadside", "My battery died on the highway, is towing included in my plan?"),
+    ("quote", "I'm adding a teenage driver to my policy, what would that cost?"),
+    ("cancel", "I sold my car and want to cancel the policy on it."),
+    ("glass", "A rock cracked my windshield, is glass repair covered?"),
+    ("address", "I moved to a new state, how do I update my address and policy?"),
+]
+
+
+def synthesize(path, n_tickets, n_poisoned=1, seed=0):
+    """Writes a JSONL corpus of benign tickets with `n_poisoned` carrying the injection"""
+    from config import POISONED_TICKET
+
+    rng = random.Random(seed)
+    poisoned = set(rng.sample(range(n_tickets), min(n_poisoned, n_tickets)))
+    with open(path, "w") as f:
+        for number in range(n_tickets):
+            topic, text = rng.choice(TOPICS)
+            if number in poisoned:
+                text = f"{text}\n{POISONED_TICKET}"
+            ticket = {"id": f"ticket-{number:08d}", "subject": f"Question about {topic}", "body": text}
+            f.write(json.dumps(ticket) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Search Index",
+        description="Builds, appends to and queries a BM25 index of support tickets",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="index JSONL tickets, appending to the index")
+    ingest.add_argument("index")
+    ingest.add_argument("tickets", nargs="+", help="JSONL files")
+    ingest.add_argument("--segment-docs", type=int, default=SEGMENT_DOCS)
+
+    query = commands.add_parser("search", help="print the top tickets for a query")
+    query.add_argument("index")
+    query.add_argument("q")
+    query.add_argument("-k", type=int, default=3)
+    query.add_argument("--budget", type=float, help="seconds to spend scoring")
+
+    corpus = commands.add_parser("synthesize", help="write a synthetic JSONL ticket corpus")
+    corpus.add_argument("tickets")
+    corpus.add_argument("-n", "--tickets-count", type=int, default=100_000)
+    corpus.add_argument("--poisoned", type=int, default=1, help="tickets carrying the injection")
+    corpus.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        index = SearchIndex(args.index)
+        for path in args.tickets:
+            started = time.perf_counter()
+            added = index.add(read_tickets(path), args.segment_docs)
+            print(f"indexed {added} tickets from {path} in {time.perf_counter() - started:.1f}s")
+        print(index.n_docs, "tickets in", args.index)
+    elif args.command == "search":
+        started = time.perf_counter()
+        hits = SearchIndex(args.index).search(args.q, args.k, args.budget)
+        print(f"{len(hits)} hits in {(time.perf_counter() - started) * 1e3:.1f} ms")
+        for hit in hits:
+            print(f"\n{hit['id']} ({hit['score']:.2f})\n{hit['snippet']}")
+    else:
+        synthesize(args.tickets, args.tickets_count, args.poisoned, args.seed)
+        print("wrote", args.tickets_count, "tickets to", args.tickets)
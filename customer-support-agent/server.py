@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Serves many support chats from one process, as a small ASGI app.
+
+Every conversation is an `AsyncChatBot` on the one event loop, and they all
+share one `AsyncAnthropic` connection pool. A turn waiting on the API or on a
+tool holds no thread, so a process serves hundreds of chats at once. Memory
+stays bounded: a session ends after `MAX_TURNS` turns, the model only sees a
+`ContextWindow` of the recent ones, and sessions idle for `SESSION_TTL`
+seconds, or beyond `MAX_SESSIONS`, are dropped, least recently used first.
+
+    POST   /sessions                  {"guard": false}    -> {"session_id": ...}
+    POST   /sessions/<id>/messages    {"message": "..."}  -> {"response": ..., "usage": {...}}
+    DELETE /sessions/<id>
+    GET    /health                                        -> {"sessions": ...}
+
+Serve it with any ASGI server, e.g. `uvicorn server:app`, which `python server.py`
+uses too.
+"""
+import argparse
+import json
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from chatbot import AsyncChatBot, SessionState
+from clients import make_async_client
+from config import TASK_SPECIFIC_INSTRUCTIONS
+from context import ContextWindow
+
+MAX_SESSIONS = 1000
+SESSION_TTL = 30 * 60
+MAX_TURNS = 50
+CONTEXT_TURNS = 8
+
+
+class Session:
+    def __init__(self, chatbot):
+        self.chatbot = chatbot
+        self.turns = 0
+        self.last_used = time.monotonic()
+
+
+class Sessions:
+    """The live conversations, least recently used first.
+
+    `chatbot_kwargs` are passed on to every `AsyncChatBot`, by default the
+    app's cached system prompt and context window.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        max_sessions=MAX_SESSIONS,
+        ttl=SESSION_TTL,
+        max_turns=MAX_TURNS,
+        **chatbot_kwargs,
+    ):
+        self._client = client
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.chatbot_kwargs = {
+            "static_context": TASK_SPECIFIC_INSTRUCTIONS,
+            "prompt_cache": True,
+            **chatbot_kwargs,
+        }
+        self.sessions = OrderedDict()
+
+    @property
+    def client(self):
+        # made on first use, from within the server's event loop
+        if self._client is None:
+            self._client = make_async_client()
+        return self._client
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, guard=False):
+        self.expire()
+        session_id = str(uuid4())
+        context = ContextWindow(CONTEXT_TURNS)
+        self.sessions[session_id] = Session(
+            AsyncChatBot(
+                SessionState(),
+                use_guardrails=guard,
+                client=self.client,
+                context=context,
+                **self.chatbot_kwargs,
+            )
+        )
+        return session_id
+
+    def get(self, session_id):
+        """The session, now the most recently used, or None if it ended or never existed"""
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def delete(self, session_id):
+        return self.sessions.pop(session_id, None) is not None
+
+    def expire(self):
+        """Drops idle sessions, and the least recently used ones past `max_sessions`"""
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            over = len(self.sessions) >= self.max_sessions
+            if not over and now - session.last_used < self.ttl:
+                break
+            if not session.chatbot.lock.locked():
+                del self.sessions[session_id]
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+
+
+class ChatApp:
+    """The ASGI application"""
+
+    def __init__(self, sessions=None):
+        self.sessions = sessions if sessions is not None else Sessions()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        try:
+            body = await read_body(receive)
+            status, payload = await self.route(
+                scope["method"], scope["path"].rstrip("/"), json.loads(body) if body else {}
+            )
+        except json.JSONDecodeError:
+            status, payload = 400, {"error": "The body isn't valid JSON"}
+        except Exception as e:
+            status, payload = 500, {"error": str(e)}
+        await send_json(send, status, payload)
+
+    async def route(self, method, path, body):
+        parts = path.strip("/").split("/")
+        if parts == ["health"] and method == "GET":
+            return 200, {"sessions": len(self.sessions)}
+
+        if parts == ["sessions"] and method == "POST":
+            return 201, {"session_id": self.sessions.create(bool(body.get("guard", False)))}
+
+        if len(parts) == 2 and parts[0] == "sessions" and method == "DELETE":
+            if self.sessions.delete(parts[1]):
+                return 200, {}
+            return 404, {"error": "No such session"}
+
+        if len(parts) == 3 and parts[0] == "sessions" and parts[2] == "messages":
+            if method != "POST":
+                return 405, {"error": "Use POST"}
+            return await self.message(parts[1], body)
+
+        return 404, {"error": "Not found"}
+
+    async def message(self, session_id, body):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return 404, {"error": "No such session"}
+        if not isinstance(body.get("message"), str) or not body["message"]:
+            return 400, {"error": "Expected a message"}
+        if session.turns >= self.sessions.max_turns:
+            return 409, {"error": "This session has ended, start a new one"}
+
+        session.turns += 1
+        response = await session.chatbot.process_user_input(body["message"])
+        return 200, {"response": response, "usage": session.chatbot.usage.as_dict()}
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.sessions.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+app = ChatApp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Chat Server",
+        description="Serves concurrent support chats over HTTP",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS)
+    parser.add_argument("--session-ttl", type=float, default=SESSION_TTL, help="idle seconds")
+    args = parser.parse_args()
+
+    # only needed to serve from here, any other ASGI server can run `app`
+    import uvicorn
+
+    uvicorn.run(
+        ChatApp(Sessions(max_sessions=args.max_sessions, ttl=args.session_ttl)),
+        host=args.host,
+        port=args.port,
+    )
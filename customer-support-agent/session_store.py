@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Columnar storage for simulated sessions.
+
+Every content block of every message becomes one row. Rows are appended as Arrow
+IPC stream batches to a `sessions-<uuid>.arrows` part file owned by a single
+writer, so concurrent simulation processes can share an output folder, and a
+part cut short by a crash still loads up to its last complete batch. A writer
+puts each session on disk as it's given one, unless it's asked to buffer them
+into batches of about `BATCH_ROWS` rows, which later reads get through faster
+but which a crash loses whole.
+
+Unlike the pickles, reading these files doesn't need `anthropic` installed.
+"""
+import argparse
+import json
+import pickle
+from pathlib import Path
+from uuid import uuid4
+
+import pyarrow as pa
+
+PART_GLOB = "sessions-*.arrows"
+BATCH_ROWS = 4096
+
+SCHEMA = pa.schema(
+    [
+        ("session_id", pa.string()),
+        ("turn", pa.int32()),
+        ("message_index", pa.int32()),
+        ("block_index", pa.int32()),
+        ("role", pa.string()),
+        ("block_type", pa.string()),
+        ("text", pa.string()),
+        ("tool_name", pa.string()),
+        ("tool_input", pa.string()),
+        ("tool_use_id", pa.string()),
+        ("guard", pa.bool_()),
+        # the prescreen's verdict on a tool result: matched rules, "" if clean
+        ("prescreen", pa.string()),
+    ]
+)
+
+
+def to_jsonable(messages):
+    """Converts `anthropic` content blocks in `messages` to plain dicts"""
+    return [
+        {
+            "role": message["role"],
+            "content": (
+                message["content"]
+                if isinstance(message["content"], str)
+                else [_block_as_dict(block) for block in message["content"]]
+            ),
+        }
+        for message in messages
+    ]
+
+
+def _block_as_dict(block):
+    if isinstance(block, dict):
+        return block
+    return block.model_dump(exclude_none=True)
+
+
+def _tool_result_text(content):
+    if content is None or isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def flatten_session(session_id, messages, guard=False, verdicts=None):
+    """Returns one row per content block, `turn` counting the user's text messages.
+
+    `verdicts` maps a `tool_use_id` to the prescreen verdict on its result.
+    """
+    verdicts = verdicts or {}
+    rows = []
+    turn = -1
+    for message_index, message in enumerate(to_jsonable(messages)):
+        content = message["content"]
+        if isinstance(content, str):
+            if message["role"] == "user":
+                turn += 1
+            content = [{"type": "text", "text": content}]
+
+        for block_index, block in enumerate(content):
+            block_type = block["type"]
+            row = {
+                "session_id": session_id,
+                "turn": max(turn, 0),
+                "message_index": message_index,
+                "block_index": block_index,
+                "role": message["role"],
+                "block_type": block_type,
+                "text": None,
+                "tool_name": None,
+                "tool_input": None,
+                "tool_use_id": None,
+                "guard": guard,
+                "prescreen": None,
+            }
+
+            if block_type == "text":
+                row["text"] = block["text"]
+            elif block_type == "tool_use":
+                row["tool_name"] = block["name"]
+                row["tool_input"] = json.dumps(block["input"], sort_keys=True)
+                row["tool_use_id"] = block["id"]
+            elif block_type == "tool_result":
+                row["text"] = _tool_result_text(block.get("content"))
+                row["tool_use_id"] = block["tool_use_id"]
+                if block["tool_use_id"] in verdicts:
+                    row["prescreen"] = verdicts[block["tool_use_id"]].label
+
+            rows.append(row)
+
+    return rows
+
+
+class SessionWriter:
+    """Appends flattened sessions to a new part file in `folder`.
+
+    Each session is written as its own batch, or with `batch_rows`, buffered
+    until they add up to that many rows. `write`, `flush` and `close` return
+    the ids of the sessions they put on disk, which is when a caller can
+    consider them saved.
+    """
+
+    def __init__(self, folder, batch_rows=0):
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        self.path = folder / f"sessions-{uuid4()}.arrows"
+        self.batch_rows = batch_rows
+        self._writer = None
+        self._rows = []
+        self._session_ids = []
+
+    def write(self, session_id, messages, guard=False, verdicts=None):
+        self._rows.extend(flatten_session(session_id, messages, guard, verdicts))
+        self._session_ids.append(session_id)
+        if len(self._rows) >= self.batch_rows:
+            return self.flush()
+        return []
+
+    def flush(self):
+        written = self._session_ids
+        if self._rows:
+            if self._writer is None:
+                self._writer = pa.ipc.new_stream(str(self.path), SCHEMA)
+            self._writer.write_batch(pa.RecordBatch.from_pylist(self._rows, schema=SCHEMA))
+        self._rows, self._session_ids = [], []
+        return written
+
+    def close(self):
+        written = self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        return written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_part(path, columns=None, skip=0):
+    """Memory-maps one part file, materializing only `columns`.
+
+    Columns added to `SCHEMA` after the file was written read as nulls.
+    """
+    schema = _schema(columns)
+    return pa.Table.from_batches(list(read_batches(path, columns, skip)), schema=schema)
+
+
+def read_batches(path, columns=None, skip=0):
+    """Yields the complete record batches of a part file, after the first `skip`"""
+    schema = _schema(columns)
+    with pa.memory_map(str(path)) as source:
+        try:
+            reader = pa.ipc.open_stream(source)
+            for index, batch in enumerate(reader):
+                if index >= skip:
+                    yield _conform(batch, schema)
+        except pa.ArrowInvalid:
+            # the part is still being written, or its writer died mid-batch
+            pass
+
+
+def _schema(columns):
+    return SCHEMA if columns is None else pa.schema([SCHEMA.field(c) for c in columns])
+
+
+def _conform(batch, schema):
+    if batch.schema.equals(schema):
+        return batch
+    if all(
+        batch.schema.get_field_index(field.name) >= 0
+        and batch.schema.field(field.name).type == field.type
+        for field in schema
+    ):
+        return batch.select(schema.names)
+
+    # written with an older schema
+    columns = []
+    for field in schema:
+        if batch.schema.get_field_index(field.name) < 0:
+            columns.append(pa.nulls(batch.num_rows, field.type))
+        else:
+            columns.append(batch.column(field.name).cast(field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def part_files(folder):
+    return sorted(Path(folder).glob(PART_GLOB))
+
+
+def load_messages(folder, columns=None):
+    """Loads every part file in `folder` as one `pyarrow.Table`"""
+    tables = [read_part(path, columns) for path in part_files(folder)]
+    if not tables:
+        return SCHEMA.empty_table().select(columns or SCHEMA.names)
+    return pa.concat_tables(tables)
+
+
+def convert_pickles(folder, guard=False):
+    """Copies the legacy `<uuid>.pkl` sessions in `folder` into a part file.
+
+    Only unpickle files that you trust completely.
+    """
+    pickles = sorted(Path(folder).glob("*.pkl"))
+    with SessionWriter(folder, BATCH_ROWS) as writer:
+        for path in pickles:
+            writer.write(path.stem, pickle.loads(path.read_bytes()), guard)
+
+    return writer.path, len(pickles)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Session Store",
+        description="Converts pickled sessions in a folder to the columnar session store",
+    )
+    parser.add_argument("folder")
+    parser.add_argument("-g", "--guard", action="store_true", help="sessions were run with --guard")
+    args = parser.parse_args()
+
+    path, n_sessions = convert_pickles(args.folder, args.guard)
+    print("wrote", n_sessions, "sessions to", path)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""A local stand-in for the Messages API, for load tests and offline runs.
+
+Point a client at it with `Anthropic(base_url="http://127.0.0.1:8765")` (or set
+`ANTHROPIC_BASE_URL`); any API key is accepted. Replies come from
+`stub_model.respond`, which plays out the poisoned `search` flow, or from a
+`--script` of recorded content blocks. The latency model delays the first token
+by `--ttft` seconds and then generates `--tokens-per-second`, and can inject
+429 and 529 errors.
+
+The Message Batches endpoints are served too: a batch is answered on a
+background thread and ends `--batch-delay` seconds after it was created.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import cycle
+from urllib.parse import urlsplit
+
+from stub_model import estimate_tokens, make_message, respond
+
+
+class LatencyModel:
+    """How slowly, and how unreliably, the stand-in answers"""
+
+    def __init__(
+        self,
+        ttft=0.0,
+        tokens_per_second=0.0,
+        jitter=0.0,
+        rate_limit_rate=0.0,
+        overload_rate=0.0,
+        requests_per_minute=None,
+        retry_after=1.0,
+        seed=None,
+    ):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.overload_rate = overload_rate
+        self.requests_per_minute = requests_per_minute
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = deque()
+
+    def first_token_delay(self):
+        with self._lock:
+            return max(0.0, self.ttft + self._random.uniform(-self.jitter, self.jitter))
+
+    def token_delay(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def admit(self):
+        """Returns `(status, error_type, rate limit headers)` for an incoming request"""
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+
+            headers = {}
+            if self.requests_per_minute:
+                remaining = self.requests_per_minute - len(self._recent)
+                reset = 60 - (now - self._recent[0]) if self._recent else 60
+                headers = {
+                    "anthropic-ratelimit-requests-limit": str(self.requests_per_minute),
+                    "anthropic-ratelimit-requests-remaining": str(max(0, remaining - 1)),
+                    "anthropic-ratelimit-requests-reset": f"{reset:.3f}",
+                }
+                if remaining <= 0:
+                    return 429, "rate_limit_error", {**headers, "retry-after": f"{reset:.3f}"}
+
+            roll = self._random.random()
+            if roll < self.rate_limit_rate:
+                return 429, "rate_limit_error", {**headers, "retry-after": str(self.retry_after)}
+            if roll < self.rate_limit_rate + self.overload_rate:
+                return 529, "overloaded_error", headers
+
+            self._recent.append(now)
+            return 200, None, headers
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=None, script=None, batch_delay=0.0):
+        super().__init__(address, StubHandler)
+        self.latency = latency or LatencyModel()
+        self.script = cycle(script) if script else None
+        self.script_lock = threading.Lock()
+        self.cached_prefixes = set()
+        self.batch_delay = batch_delay
+        self.batches = {}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def reply(self, params):
+        if self.script is None:
+            return make_message(respond(params), params)
+
+        with self.script_lock:
+            scripted = next(self.script)
+        if isinstance(scripted, list):
+            return make_message(scripted, params)
+        return scripted
+
+    def cache_usage(self, params):
+        """Mimics prompt caching: the tools and system prompt are written once, then read"""
+        if "cache_control" not in json.dumps([params.get("tools"), params.get("system")]):
+            return {}
+
+        prefix = {"tools": params.get("tools"), "system": params.get("system"), "messages": []}
+        key = hashlib.sha256(json.dumps(prefix, sort_keys=True).encode()).hexdigest()
+        tokens = estimate_tokens(prefix)
+        with self.script_lock:
+            hit = key in self.cached_prefixes
+            self.cached_prefixes.add(key)
+        if hit:
+            return {"cache_read_input_tokens": tokens, "cache_creation_input_tokens": 0}
+        return {"cache_read_input_tokens": 0, "cache_creation_input_tokens": tokens}
+
+    def answer(self, params):
+        """The whole message for `params`, with usage adjusted for prompt caching"""
+        message = self.reply(params)
+        usage = self.cache_usage(params)
+        if usage:
+            uncached = max(1, message["usage"]["input_tokens"] - sum(usage.values()))
+            message["usage"] = {**message["usage"], **usage, "input_tokens": uncached}
+        return message
+
+    def create_batch(self, requests):
+        created = datetime.now(timezone.utc)
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+        batch = {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "in_progress",
+            "request_counts": {
+                "processing": len(requests),
+                "succeeded": 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": created.isoformat(),
+            "expires_at": (created + timedelta(days=1)).isoformat(),
+            "ended_at": None,
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": None,
+        }
+        self.batches[batch_id] = {"batch": batch, "results": None}
+        threading.Thread(target=self.process_batch, args=(batch_id, requests), daemon=True).start()
+        return batch
+
+    def process_batch(self, batch_id, requests):
+        started = time.monotonic()
+        results = []
+        for request in requests:
+            try:
+                result = {"type": "succeeded", "message": self.answer(request["params"])}
+            except Exception as e:
+                result = {"type": "errored", "error": error("api_error", str(e))}
+            results.append({"custom_id": request["custom_id"], "result": result})
+        time.sleep(max(0.0, self.batch_delay - (time.monotonic() - started)))
+
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        for result in results:
+            counts[result["result"]["type"]] += 1
+        batch = self.batches[batch_id]["batch"]
+        self.batches[batch_id] = {
+            "batch": {
+                **batch,
+                "processing_status": "ended",
+                "request_counts": counts,
+                "ended_at": datetime.now(timezone.utc).isoformat(),
+                "results_url": f"{self.base_url}/v1/messages/batches/{batch_id}/results",
+            },
+            "results": results,
+        }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("content-length", 0)))
+        path = urlsplit(self.path).path
+        if path not in ("/v1/messages", "/v1/messages/batches"):
+            return self.send_json(404, error("not_found_error", f"No route for {self.path}"))
+
+        params = json.loads(body)
+        status, error_type, headers = self.server.latency.admit()
+        if status != 200:
+            return self.send_json(status, error(error_type, "Injected by the stub server"), headers)
+
+        if path == "/v1/messages/batches":
+            return self.send_json(200, self.server.create_batch(params["requests"]), headers)
+
+        message = self.server.answer(params)
+        if params.get("stream"):
+            return self.send_stream(message, headers)
+
+        time.sleep(
+            self.server.latency.first_token_delay()
+            + message["usage"]["output_tokens"] * self.server.latency.token_delay()
+        )
+        self.send_json(200, message, headers)
+
+    def do_GET(self):
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        if parts[:3] != ["v1", "messages", "batches"] or len(parts) not in (4, 5):
+            return self.send_json(404, error("not_found_error", f"No route for {self.path}"))
+
+        stored = self.server.batches.get(parts[3])
+        if stored is None:
+            return self.send_json(404, error("not_found_error", f"No batch {parts[3]}"))
+        if len(parts) == 4:
+            return self.send_json(200, stored["batch"])
+        if parts[4] != "results" or stored["results"] is None:
+            return self.send_json(404, error("not_found_error", f"No results for {parts[3]}"))
+
+        data = "".join(json.dumps(result) + "\n" for result in stored["results"]).encode()
+        self.send_response(200)
+        self.send_header("content-type", "application/x-jsonl")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, message, headers):
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.send_header("cache-control", "no-cache")
+        self.send_header("connection", "close")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.close_connection = True
+
+        time.sleep(self.server.latency.first_token_delay())
+        for event in stream_events(message):
+            self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+            self.wfile.flush()
+            if event["type"] == "content_block_delta":
+                time.sleep(self.server.latency.token_delay())
+
+
+def error(error_type, message):
+    return {"type": "error", "error": {"type": error_type, "message": message}}
+
+
+def chunks(text, size=4):
+    return [text[start : start + size] for start in range(0, len(text), size)] or [""]
+
+
+def stream_events(message):
+    """The server-sent events that stream `message`, about one token per delta"""
+    usage = message["usage"]
+    yield {
+        "type": "message_start",
+        "message": {
+            **message,
+            "content": [],
+            "stop_reason": None,
+            "usage": {**usage, "output_tokens": 1},
+        },
+    }
+
+    for index, block in enumerate(message["content"]):
+        if block["type"] == "text":
+            yield {
+                "type": "content_block_start",
+                "index": index,
+                "content_block": {"type": "text", "text": ""},
+            }
+            for text in chunks(block["text"]):
+                yield {
+                    "type": "content_block_delta",
+                    "index": index,
+                    "delta": {"type": "text_delta", "text": text},
+                }
+        else:
+            yield {
+                "type": "content_block_start",
+                "index": index,
+                "content_block": {**block, "input": {}},
+            }
+            for partial_json in chunks(json.dumps(block["input"]), size=8):
+                yield {
+                    "type": "content_block_delta",
+                    "index": index,
+                    "delta": {"type": "input_json_delta", "partial_json": partial_json},
+                }
+        yield {"type": "content_block_stop", "index": index}
+
+    yield {
+        "type": "message_delta",
+        "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+        "usage": {"output_tokens": usage["output_tokens"]},
+    }
+    yield {"type": "message_stop"}
+
+
+def load_script(path):
+    """Reads one reply per line: a list of content blocks, or a whole message body"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def serve_in_thread(host="127.0.0.1", port=0, latency=None, script=None, batch_delay=0.0):
+    """Starts a server on a background thread and returns it, see `StubServer.base_url`"""
+    server = StubServer((host, port), latency, script, batch_delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Stub Server",
+        description="Serves a local, Anthropic-compatible Messages API with a configurable latency model",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds added to --ttft")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of 429s")
+    parser.add_argument("--overload-rate", type=float, default=0.0, help="share of 529s")
+    parser.add_argument("--rpm", type=int, help="requests per minute before answering 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--batch-delay", type=float, default=0.0, help="seconds a batch takes")
+    parser.add_argument(
+        "--script", help="JSONL of replies to serve in order, instead of the stub model"
+    )
+    args = parser.parse_args()
+
+    latency = LatencyModel(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        jitter=args.jitter,
+        rate_limit_rate=args.rate_limit_rate,
+        overload_rate=args.overload_rate,
+        requests_per_minute=args.rpm,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    script = load_script(args.script) if args.script else None
+    server = StubServer((args.host, args.port), latency, script, args.batch_delay)
+    print(f"serving the Messages API on {server.base_url}")
+    server.serve_forever()
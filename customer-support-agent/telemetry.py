@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Spans around the phases of the agent loop, with token usage and cost.
+
+A `Tracer` times nested spans (a session, its turns, and each model call, tool
+and salt wrapping within them) and hands every finished span to an exporter.
+`JsonlExporter` writes one flat JSON object per span, which `analysis.py` reads
+back; with `format="otel"` it writes OpenTelemetry-style span records instead.
+`NOOP_TRACER`, the default, does nothing and costs about a function call.
+"""
+import json
+import threading
+import time
+from contextvars import ContextVar
+from uuid import uuid4
+
+# USD per million tokens
+MODEL_PRICES = {
+    "claude-3-5-sonnet-20240620": {
+        "input_tokens": 3.00,
+        "cache_creation_input_tokens": 3.75,
+        "cache_read_input_tokens": 0.30,
+        "output_tokens": 15.00,
+    },
+}
+
+USAGE_FIELDS = (
+    "input_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+    "output_tokens",
+)
+
+_current_span = ContextVar("current_span", default=None)
+
+
+def cost(usage, model):
+    """The price of `usage` (a dict of token counts) in USD, or None for an unknown model"""
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return sum(usage.get(field, 0) * price for field, price in prices.items()) / 1e6
+
+
+class Span:
+    def __init__(self, tracer, name, trace_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def usage(self, usage, model):
+        """Records the token counts of a response's `usage`, and what they cost"""
+        counts = {field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}
+        self.attributes.update(counts, model=model, cost=cost(counts, model))
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None:
+            self.parent_id = parent.span_id
+            self.trace_id = self.trace_id or parent.trace_id
+        self.trace_id = self.trace_id or uuid4().hex
+        self._token = _current_span.set(self)
+        self.start = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self._started
+        if exc is not None:
+            self.attributes["error"] = repr(exc)
+        _current_span.reset(self._token)
+        self.tracer.exporter.export(self)
+
+
+class Tracer:
+    def __init__(self, exporter):
+        self.exporter = exporter
+
+    def span(self, name, trace_id=None, **attributes):
+        """A context manager timing `name`, nested in the span that's current when it's entered"""
+        return Span(self, name, trace_id, attributes)
+
+    def close(self):
+        self.exporter.close()
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def usage(self, usage, model):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        pass
+
+
+class _NoopTracer:
+    _span = _NoopSpan()
+
+    def span(self, name, trace_id=None, **attributes):
+        return self._span
+
+    def close(self):
+        pass
+
+
+NOOP_TRACER = _NoopTracer()
+
+
+class JsonlExporter:
+    """Appends each span to `path` as a JSON line, flat (`jsonl`) or OpenTelemetry-style (`otel`)"""
+
+    def __init__(self, path, format="jsonl"):
+        if format not in ("jsonl", "otel"):
+            raise ValueError(f"Unknown telemetry format: {format}")
+        self.format = format
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        record = flat_record(span) if self.format == "jsonl" else otel_record(span)
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+def flat_record(span):
+    return {
+        "name": span.name,
+        "trace_id": span.trace_id,
+        "span_id": span.span_id,
+        "parent_id": span.parent_id,
+        "start": span.start,
+        "duration": span.duration,
+        **span.attributes,
+    }
+
+
+def _otel_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otel_record(span):
+    start = int(span.start * 1e9)
+    return {
+        "traceId": span.trace_id.replace("-", "")[:32].ljust(32, "0"),
+        "spanId": span.span_id,
+        "parentSpanId": span.parent_id or "",
+        "name": span.name,
+        "startTimeUnixNano": str(start),
+        "endTimeUnixNano": str(start + int(span.duration * 1e9)),
+        "attributes": [
+            {"key": key, "value": _otel_value(value)}
+            for key, value in span.attributes.items()
+            if value is not None
+        ],
+        "status": {"code": 2 if "error" in span.attributes else 1},
+    }
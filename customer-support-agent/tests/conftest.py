@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules live flat in customer-support-agent/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
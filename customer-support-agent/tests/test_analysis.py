@@ -0,0 +1,24 @@
+from analysis import prescreen_report
+from chatbot import INITIAL_PROMPT, ChatBot, SessionState
+from prescreen import Prescreen
+from session_store import SessionWriter
+from stub_model import StubAnthropic
+
+
+def test_prescreen_report_counts_salt_escalations(tmp_path):
+    with SessionWriter(tmp_path) as writer:
+        for index in range(3):
+            chatbot = ChatBot(
+                SessionState(),
+                use_guardrails=True,
+                client=StubAnthropic(),
+                prescreen=Prescreen(mode="shadow"),
+            )
+            messages = chatbot.simulate_conversation(INITIAL_PROMPT, num_turns=2)
+            writer.write(str(index), messages, True, chatbot.verdicts)
+
+    report = prescreen_report(tmp_path)
+    # the salted stub escalates in the follow-up to every poisoned search
+    assert report.loc["salt", "flagged"] == 3
+    assert report.loc["salt", "true_positives"] == 3
+    assert report.loc["prescreen", "flagged"] == 3
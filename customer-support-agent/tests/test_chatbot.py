@@ -0,0 +1,153 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from anthropic.types import Message, ToolUseBlock
+
+import config
+from chatbot import INITIAL_PROMPT, MAX_TOOL_ROUNDS, AsyncChatBot, ChatBot, SessionState
+from response_cache import ResponseCache
+from session_store import to_jsonable
+from stub_model import StubAnthropic, make_message
+
+
+class AsyncStubAnthropic(StubAnthropic):
+    """`StubAnthropic` behind coroutines, for `AsyncChatBot`"""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = self
+        self.beta.prompt_caching.messages = self
+        self._stub = StubAnthropic()
+
+    async def create(self, **params):
+        return self._stub.messages.create(**params)
+
+
+class SearchingAnthropic:
+    """Answers every request with a `search` call and nothing else"""
+
+    def __init__(self):
+        self.messages = self
+        self.requests = []
+
+    def with_options(self, **options):
+        return self
+
+    def create(self, **params):
+        self.requests.append(params)
+        tool_use = {
+            "type": "tool_use",
+            "id": f"toolu_{len(self.requests)}",
+            "name": "search",
+            "input": {"q": "coverage"},
+        }
+        return Message.model_validate(make_message([tool_use], params))
+
+
+def without_ids(messages):
+    """`messages` as plain dicts, without the random tool use ids"""
+    return [
+        {
+            "role": message["role"],
+            "content": (
+                message["content"]
+                if isinstance(message["content"], str)
+                else [
+                    {key: value for key, value in block.items() if key not in ("id", "tool_use_id")}
+                    for block in message["content"]
+                ]
+            ),
+        }
+        for message in to_jsonable(messages)
+    ]
+
+
+@pytest.fixture(autouse=True)
+def instant_quotes(monkeypatch):
+    monkeypatch.setattr(config, "QUOTE_LATENCY", 0)
+
+
+def test_sync_and_async_chatbots_hold_the_same_conversation():
+    sync = ChatBot(SessionState(), client=StubAnthropic())
+    messages = sync.simulate_conversation(INITIAL_PROMPT, num_turns=4)
+
+    chatbot = AsyncChatBot(SessionState(), client=AsyncStubAnthropic())
+    async_messages = asyncio.run(chatbot.simulate_conversation(INITIAL_PROMPT, num_turns=4))
+
+    assert without_ids(async_messages) == without_ids(messages)
+    assert chatbot.usage.as_dict() == sync.usage.as_dict()
+
+
+def test_async_chatbot_refuses_to_stream():
+    chatbot = AsyncChatBot(SessionState(), client=AsyncStubAnthropic())
+    with pytest.raises(NotImplementedError):
+        chatbot.process_user_input_stream(INITIAL_PROMPT)
+
+
+def test_a_turn_ending_in_tool_calls_sends_no_empty_assistant_message():
+    client = SearchingAnthropic()
+    chatbot = ChatBot(SessionState(), client=client)
+
+    assert chatbot.process_user_input(INITIAL_PROMPT) == ""
+    assert len(client.requests) == MAX_TOOL_ROUNDS + 1
+    chatbot.process_user_input("Are you there?")
+
+    for params in client.requests:
+        for message in params["messages"]:
+            assert message["content"] not in ("", [])
+
+
+def test_async_chatbot_uses_the_response_cache_off_the_event_loop(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.sqlite")
+    threads = []
+    for method in ("lookup", "store"):
+        original = getattr(cache, method)
+
+        def recorded(*args, original=original):
+            threads.append(threading.current_thread())
+            return original(*args)
+
+        setattr(cache, method, recorded)
+
+    chatbot = AsyncChatBot(SessionState(), client=AsyncStubAnthropic(), response_cache=cache)
+    asyncio.run(chatbot.process_user_input("Do you offer roadside assistance?"))
+    assert threads
+    assert threading.main_thread() not in threads
+    assert cache.stats()["stored"] == len(threads) // 2
+
+
+def test_a_tool_past_its_timeout_is_answered_with_an_error(monkeypatch):
+    monkeypatch.setitem(config.TOOL_TIMEOUTS, "search", 0.1)
+    release = threading.Event()
+
+    def stuck_search(q):
+        release.wait(5)
+        return "too late"
+
+    chatbot = ChatBot(
+        SessionState(),
+        client=StubAnthropic(),
+        tool_functions={"search": stuck_search, "call_manager": lambda: "on the way"},
+    )
+    tool_uses = [
+        ToolUseBlock(type="tool_use", id="toolu_1", name="search", input={"q": "cover"}),
+        ToolUseBlock(type="tool_use", id="toolu_2", name="call_manager", input={}),
+    ]
+    started = time.monotonic()
+    try:
+        timed_out, answered = chatbot.run_tools(tool_uses)
+    finally:
+        release.set()
+
+    assert time.monotonic() - started < 1
+    assert timed_out == {
+        "type": "tool_result",
+        "tool_use_id": "toolu_1",
+        "content": "search timed out after 0.1s",
+        "is_error": True,
+    }
+    assert answered["tool_use_id"] == "toolu_2"
+    assert answered["content"].endswith("on the way")
+    assert "is_error" not in answered
@@ -0,0 +1,86 @@
+import pytest
+
+from chatbot import INITIAL_PROMPT, ChatBot, SessionState
+from checkpoint import RunManifest, written_session_ids
+from session_store import SessionWriter, to_jsonable
+from stub_model import StubAnthropic
+
+CONFIG = {"guard": False, "turns": 4}
+
+
+def counting_client():
+    client = StubAnthropic()
+    client.requests = []
+    create = client.messages.create
+
+    def counted(**params):
+        client.requests.append(params)
+        return create(**params)
+
+    client.messages.create = counted
+    return client
+
+
+def simulate(manifest, session_id, num_turns, client=None):
+    chatbot = ChatBot(SessionState(), client=client or StubAnthropic())
+    log = manifest.log(session_id)
+    try:
+        messages = chatbot.simulate_conversation(
+            INITIAL_PROMPT, num_turns=num_turns, session_id=session_id, log=log
+        )
+    finally:
+        log.close()
+    return messages, log
+
+
+def test_a_resumed_session_simulates_only_the_turns_it_is_missing(tmp_path):
+    manifest = RunManifest(tmp_path, CONFIG)
+    interrupted, log = simulate(manifest, "a", num_turns=2)
+    with open(log.path, "a") as f:
+        f.write('{"turn": 2, "mess')  # cut short by the crash
+    manifest.close()
+
+    manifest = RunManifest(tmp_path, CONFIG, resume=True)
+    assert manifest.unfinished() == ["a"]
+    client = counting_client()
+    messages, _ = simulate(manifest, "a", num_turns=4, client=client)
+
+    assert to_jsonable(messages[: len(interrupted)]) == to_jsonable(interrupted)
+    assert messages[len(interrupted)]["role"] == "user"
+    # a user simulation and the agent's replies for each of the two turns left
+    assert sum(1 for params in client.requests if not params.get("tools")) == 2
+    assert [turn["turn"] for turn in manifest.log("a").turns] == [0, 1, 2, 3]
+
+
+def test_a_resumed_run_skips_the_sessions_already_written(tmp_path):
+    manifest = RunManifest(tmp_path, CONFIG)
+    written, unfinished, unmarked = manifest.session_ids(4, iter("abcd").__next__)[:3]
+    with SessionWriter(tmp_path) as writer:
+        for session_id in (written, unmarked):
+            messages, log = simulate(manifest, session_id, num_turns=1)
+            writer.write(session_id, messages)
+            if session_id == written:
+                manifest.finish(session_id, log)
+    simulate(manifest, unfinished, num_turns=1)
+    manifest.close()
+    with open(manifest.finished_path, "a") as f:
+        f.write('"cut short')
+
+    assert written_session_ids(tmp_path) == {written, unmarked}
+    manifest = RunManifest(tmp_path, CONFIG, resume=True)
+    # stopped between writing a session and marking it finished
+    assert manifest.unfinished() == [unfinished, unmarked]
+    manifest.recover(written_session_ids(tmp_path))
+
+    assert manifest.finished == {written, unmarked}
+    assert manifest.session_ids(4, iter("xyz").__next__) == [unfinished, "x"]
+    manifest.close()
+    assert RunManifest(tmp_path, CONFIG, resume=True).finished == {written, unmarked}
+
+
+def test_an_unfinished_run_is_only_continued_with_the_same_settings(tmp_path):
+    RunManifest(tmp_path, CONFIG).close()
+    with pytest.raises(ValueError, match="--resume"):
+        RunManifest(tmp_path, CONFIG)
+    with pytest.raises(ValueError, match="turns"):
+        RunManifest(tmp_path, {**CONFIG, "turns": 10}, resume=True)
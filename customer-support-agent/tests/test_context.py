@@ -0,0 +1,106 @@
+import pytest
+
+from context import ContextWindow, extractive_summary, split_turns
+
+
+def tool_turn(number):
+    """A user question answered with one search, as `ChatBot` records it"""
+    tool_use_id = f"toolu_{number}"
+    return [
+        {"role": "user", "content": f"Question {number}"},
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": "Let me look that up."},
+                {"type": "tool_use", "id": tool_use_id, "name": "search", "input": {"q": "x"}},
+            ],
+        },
+        {
+            "role": "user",
+            "content": [{"type": "tool_result", "tool_use_id": tool_use_id, "content": "r" * 500}],
+        },
+        {"role": "assistant", "content": f"Answer {number}"},
+    ]
+
+
+def text_turn(number):
+    return [
+        {"role": "user", "content": f"Question {number}"},
+        {"role": "assistant", "content": f"Answer {number}"},
+    ]
+
+
+def conversation(turns):
+    return [
+        message
+        for number in range(turns)
+        for message in (tool_turn if number % 2 else text_turn)(number)
+    ]
+
+
+def blocks(window, block_type):
+    return [
+        block
+        for message in window
+        if not isinstance(message["content"], str)
+        for block in message["content"]
+        if block["type"] == block_type
+    ]
+
+
+def test_turns_start_at_user_text():
+    turns = split_turns(conversation(4))
+    assert [len(turn) for turn in turns] == [2, 4, 2, 4]
+    assert all(turn[0]["role"] == "user" and isinstance(turn[0]["content"], str) for turn in turns)
+
+
+@pytest.mark.parametrize("max_turns", range(1, 7))
+def test_tool_use_and_result_stay_together(max_turns):
+    window = ContextWindow(max_turns)(conversation(8))
+    tool_use_ids = [block["id"] for block in blocks(window, "tool_use")]
+    result_ids = [block["tool_use_id"] for block in blocks(window, "tool_result")]
+    assert tool_use_ids == result_ids
+    assert window[0]["role"] == "user"
+
+
+def test_older_turns_are_folded_into_the_summary_once():
+    folded = []
+
+    def summarizer(summary, messages):
+        folded.append(messages)
+        return extractive_summary(summary, messages)
+
+    window = ContextWindow(max_turns=2, summarizer=summarizer)
+    messages = conversation(3)
+    first = window(messages)
+    messages += text_turn(3)
+    second = window(messages)
+
+    # one turn folded the first time, only the new one the second
+    assert [len(messages) for messages in folded] == [2, 4]
+    assert "Question 0" in window.summary and "Question 1" in window.summary
+    assert first[0]["content"].startswith("<conversation_summary>")
+    assert second[0]["content"].endswith("Question 2")
+
+
+def test_a_different_conversation_starts_a_new_summary():
+    window = ContextWindow(max_turns=1)
+    window(conversation(3))
+    window([*text_turn(7), *text_turn(8)])
+    assert "Question 7" in window.summary
+    assert "Question 0" not in window.summary
+
+
+def test_stale_tool_results_are_clipped_but_the_last_turn_is_not():
+    window = ContextWindow(max_turns=4, stale_tool_result_chars=10)(conversation(4))
+    stale, current = [block["content"] for block in blocks(window, "tool_result")]
+    assert stale == "r" * 10 + "… [truncated, already answered]"
+    assert current == "r" * 500
+
+
+def test_zero_drops_stale_tool_result_content():
+    window = ContextWindow(max_turns=4, stale_tool_result_chars=0)(conversation(4))
+    stale, current = blocks(window, "tool_result")
+    assert "content" not in stale
+    assert stale["tool_use_id"] == "toolu_1"
+    assert current["content"] == "r" * 500
@@ -0,0 +1,52 @@
+import pytest
+from anthropic.types import Message
+
+from response_cache import ResponseCache, ResponseCacheMiss
+
+PARAMS = {
+    "model": "claude-3-5-sonnet-20240620",
+    "max_tokens": 10,
+    "messages": [{"role": "user", "content": "Hi, I'd like a quote"}],
+}
+
+
+def message(text):
+    return Message.model_validate(
+        {
+            "id": "msg_1",
+            "type": "message",
+            "role": "assistant",
+            "model": PARAMS["model"],
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": 1, "output_tokens": 1},
+        }
+    )
+
+
+def test_record_never_answers_from_the_file(tmp_path):
+    cache = ResponseCache(tmp_path / "responses.sqlite", mode="record")
+    for text in ["first", "second"]:
+        assert cache.lookup(PARAMS) is None
+        cache.store(PARAMS, message(text))
+    assert cache.stats()["stored"] == 2
+
+
+def test_identical_requests_replay_their_own_samples(tmp_path):
+    path = tmp_path / "responses.sqlite"
+    cache = ResponseCache(path, mode="record")
+    for text in ["first", "second"]:
+        cache.store(PARAMS, message(text))
+    cache.close()
+
+    # a later recording run adds samples rather than overwriting them
+    cache = ResponseCache(path, mode="record")
+    cache.store(PARAMS, message("third"))
+    cache.close()
+
+    cache = ResponseCache(path, mode="replay")
+    replayed = [cache.lookup(PARAMS).content[0].text for _ in range(3)]
+    assert replayed == ["first", "second", "third"]
+    with pytest.raises(ResponseCacheMiss):
+        cache.lookup(PARAMS)
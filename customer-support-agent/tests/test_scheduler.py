@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import anthropic
+import httpx
+import pytest
+
+from scheduler import AsyncScheduler, Scheduler, retry_after
+
+USAGE = SimpleNamespace(input_tokens=1, output_tokens=1, cache_creation_input_tokens=0)
+
+
+def bad_request():
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    return anthropic.BadRequestError(
+        "invalid request", response=httpx.Response(400, request=request), body=None
+    )
+
+
+class Resource:
+    """Fails the first `failures` calls with a 400, then succeeds"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.with_raw_response = self
+
+    def create(self, **params):
+        if self.failures:
+            self.failures -= 1
+            raise bad_request()
+        return SimpleNamespace(headers={}, parse=lambda: SimpleNamespace(usage=USAGE))
+
+
+class AsyncResource(Resource):
+    async def create(self, **params):
+        return super().create(**params)
+
+
+def test_non_retryable_errors_release_their_slot():
+    scheduler = Scheduler(initial_concurrency=2, max_concurrency=2)
+    resource = Resource(failures=5)
+    errors, results = [], []
+
+    def calls():
+        for _ in range(5):
+            try:
+                scheduler.call(resource, max_tokens=1)
+            except anthropic.BadRequestError as error:
+                errors.append(error)
+        results.append(scheduler.call(resource, max_tokens=1))
+
+    # with leaked slots the third call would wait forever
+    thread = threading.Thread(target=calls, daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    assert len(errors) == 5
+    assert results and results[0].usage is USAGE
+    assert scheduler.in_flight == 0
+
+
+def test_exhausted_retries_release_their_slot():
+    scheduler = Scheduler(initial_concurrency=1, max_concurrency=1, max_retries=0)
+    with pytest.raises(anthropic.BadRequestError):
+        scheduler.call(Resource(failures=1), max_tokens=1)
+    assert scheduler.in_flight == 0
+
+
+def test_async_non_retryable_errors_release_their_slot():
+    async def run():
+        scheduler = AsyncScheduler(initial_concurrency=2, max_concurrency=2)
+        resource = AsyncResource(failures=5)
+        for _ in range(5):
+            with pytest.raises(anthropic.BadRequestError):
+                await scheduler.call(resource, max_tokens=1)
+        assert scheduler.in_flight == 0
+        return await scheduler.call(resource, max_tokens=1)
+
+    # with leaked slots the third call would wait forever
+    assert asyncio.run(asyncio.wait_for(run(), timeout=5)).usage is USAGE
+
+
+def test_retry_after_parses_seconds_and_dates():
+    assert retry_after({"retry-after": "3"}) == 3.0
+    assert 25 < retry_after({"retry-after": formatdate(time.time() + 30, usegmt=True)}) <= 30
+    assert retry_after({"retry-after": "2000-01-01T00:00:00+00:00"}) == 0.0
+    assert retry_after({"retry-after": "soon"}) is None
+
+
+def test_starts_with_all_the_concurrency_asked_for():
+    scheduler = Scheduler(max_concurrency=16)
+    # every call waits for the other fifteen, so all sixteen have to be in flight at once
+    barrier = threading.Barrier(16, timeout=5)
+
+    class Waiting(Resource):
+        def create(self, **params):
+            barrier.wait()
+            return super().create(**params)
+
+    resource = Waiting(failures=0)
+    threads = [
+        threading.Thread(target=scheduler.call, args=(resource,), kwargs={"max_tokens": 1})
+        for _ in range(16)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert not barrier.broken
+    assert scheduler.stats()["requests"] == 16
@@ -0,0 +1,37 @@
+import pytest
+
+import search_index
+from search_index import SearchIndex
+
+TICKETS = [
+    ("a", "My windshield cracked on the highway"),
+    ("b", "Is windshield glass repair covered by my policy?"),
+    ("c", "I want to cancel the policy on my old car"),
+    ("d", "Towing for a dead battery on the highway"),
+    ("e", "My premium went up this month"),
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(tmp_path / "index")
+    index.add(TICKETS, segment_docs=2)
+    return index
+
+
+def test_scoring_over_the_corpus_or_matches_only_ranks_alike(index, monkeypatch):
+    results = []
+    for dense_scoring in (0, 2):
+        monkeypatch.setattr(search_index, "DENSE_SCORING", dense_scoring)
+        hits = index.search("windshield on the highway", k=3)
+        results.append([(hit["id"], round(hit["score"], 6)) for hit in hits])
+
+    assert results[0] == results[1]
+    assert [hit_id for hit_id, _ in results[0]] == ["a", "d", "c"]
+
+
+def test_budget_is_checked_between_segments(index, monkeypatch):
+    monkeypatch.setattr(search_index.time, "perf_counter", iter(range(100)).__next__)
+    # "policy" is in two segments, only the first is scored before the deadline
+    hits = index.search("policy highway", k=5, budget=0.5)
+    assert [hit["id"] for hit in hits] == ["b"]
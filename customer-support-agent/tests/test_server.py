@@ -0,0 +1,29 @@
+import asyncio
+
+import httpx
+from anthropic import AsyncAnthropic
+
+from server import ChatApp, Sessions
+
+
+def test_sessions_past_the_limit_are_evicted():
+    async def run():
+        app = ChatApp(Sessions(client=AsyncAnthropic(api_key="test"), max_sessions=3))
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            session_ids = []
+            for _ in range(5):
+                response = await client.post("/sessions", json={})
+                assert response.status_code == 201
+                session_ids.append(response.json()["session_id"])
+
+            health = await client.get("/health")
+            evicted = await client.post(
+                f"/sessions/{session_ids[0]}/messages", json={"message": "Hi"}
+            )
+            return session_ids, health.json(), evicted.status_code, list(app.sessions.sessions)
+
+    session_ids, health, evicted_status, live = asyncio.run(run())
+    assert health == {"sessions": 3}
+    assert evicted_status == 404
+    assert live == session_ids[-3:]
@@ -0,0 +1,40 @@
+import pyarrow as pa
+
+from session_store import SCHEMA, SessionWriter, read_batches, read_part
+
+MESSAGES = [
+    {"role": "user", "content": "Hi"},
+    {"role": "assistant", "content": "Hello, how can I help?"},
+]
+
+
+def test_writer_coalesces_sessions_into_batches(tmp_path):
+    writer = SessionWriter(tmp_path, batch_rows=4)
+    assert writer.write("a", MESSAGES) == []
+    assert writer.write("b", MESSAGES) == ["a", "b"]
+    assert writer.write("c", MESSAGES) == []
+    assert writer.close() == ["c"]
+
+    assert [batch.num_rows for batch in read_batches(writer.path)] == [4, 2]
+    assert read_part(writer.path, ["session_id"])["session_id"].to_pylist() == [
+        "a", "a", "b", "b", "c", "c"
+    ]
+
+
+def test_parts_written_with_an_older_schema_read_as_nulls(tmp_path):
+    old_schema = pa.schema([SCHEMA.field("session_id"), SCHEMA.field("text")])
+    path = tmp_path / "sessions-old.arrows"
+    with pa.ipc.new_stream(str(path), old_schema) as writer:
+        writer.write_batch(pa.RecordBatch.from_pylist([{"session_id": "a", "text": "Hi"}], schema=old_schema))
+
+    table = read_part(path)
+    assert table.schema.equals(SCHEMA)
+    assert table["text"].to_pylist() == ["Hi"]
+    assert table["prescreen"].to_pylist() == [None]
+
+
+def test_writer_puts_each_session_on_disk_unless_asked_to_batch(tmp_path):
+    writer = SessionWriter(tmp_path)
+    assert writer.write("a", MESSAGES) == ["a"]
+    assert read_part(writer.path, ["session_id"])["session_id"].to_pylist() == ["a", "a"]
+    assert writer.close() == []
@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+
+import pytest
+from anthropic.types import Message
+
+from chatbot import ChatBot, SessionState
+from config import SIDE_EFFECTING_TOOLS, SPECULATIVE_TOOLS
+from stub_model import make_message
+from tool_registry import DEFAULT_REGISTRY, REQUEST_TOOLS
+
+
+def tool_use(tool_use_id, name, **params):
+    return {"type": "tool_use", "id": tool_use_id, "name": name, "input": params}
+
+
+class ScriptedStream:
+    """A `MessageStream` over a scripted message, with an event per finished tool use"""
+
+    def __init__(self, message):
+        self.message = message
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __iter__(self):
+        for block in self.message.content:
+            if block.type == "text":
+                yield SimpleNamespace(type="text", text=block.text)
+            yield SimpleNamespace(type="content_block_stop", content_block=block)
+
+    def get_final_message(self):
+        return self.message
+
+
+class ScriptedAnthropic:
+    """Streams `replies`, one content block list per request"""
+
+    def __init__(self, *replies):
+        self.messages = self
+        self.replies = list(replies)
+
+    def with_options(self, **options):
+        return self
+
+    def stream(self, **params):
+        return ScriptedStream(Message.model_validate(make_message(self.replies.pop(0), params)))
+
+
+def streamed(client, tool_functions, **kwargs):
+    """Streams a turn, returns the chatbot and every `(tool, speculative)` call it made"""
+    chatbot = ChatBot(SessionState(), client=client, tool_functions=tool_functions, **kwargs)
+    calls = []
+    call_tool = chatbot.call_tool
+
+    def recorded(tool_use, speculative=False):
+        calls.append((tool_use.name, speculative))
+        return call_tool(tool_use, speculative)
+
+    chatbot.call_tool = recorded
+    "".join(chatbot.process_user_input_stream("What does my policy cover?"))
+    return chatbot, calls
+
+
+def tool_results(chatbot):
+    return [
+        block
+        for message in chatbot.session_state.messages
+        if message["role"] == "user" and not isinstance(message["content"], str)
+        for block in message["content"]
+    ]
+
+
+def search(q):
+    return f"results for {q}"
+
+
+def test_a_tool_started_mid_stream_is_used_when_the_model_calls_it():
+    client = ScriptedAnthropic(
+        [tool_use("toolu_1", "search", q="coverage")],
+        [{"type": "text", "text": "Liability and collision."}],
+    )
+    chatbot, calls = streamed(client, {"search": search})
+
+    assert calls == [("search", True)]
+    [result] = tool_results(chatbot)
+    assert result["tool_use_id"] == "toolu_1"
+    assert result["content"].endswith("results for coverage")
+
+
+def test_a_tool_started_for_a_superseded_message_is_discarded():
+    # the first message asks for more tools, so its search is asked for again
+    client = ScriptedAnthropic(
+        [
+            tool_use("toolu_1", "search", q="first"),
+            tool_use("toolu_2", REQUEST_TOOLS, tools=["get_quote"]),
+        ],
+        [tool_use("toolu_3", "search", q="second")],
+        [{"type": "text", "text": "Liability and collision."}],
+    )
+    chatbot, calls = streamed(client, {"search": search}, tool_registry=DEFAULT_REGISTRY)
+
+    assert calls == [("search", True), ("search", True)]
+    [result] = tool_results(chatbot)
+    assert result["tool_use_id"] == "toolu_3"
+    assert result["content"].endswith("results for second")
+
+
+@pytest.mark.parametrize("name", sorted(SIDE_EFFECTING_TOOLS))
+def test_side_effecting_tools_run_only_once_called(name):
+    assert name not in SPECULATIVE_TOOLS
+    client = ScriptedAnthropic(
+        [tool_use("toolu_1", name)],
+        [{"type": "text", "text": "Done."}],
+    )
+    chatbot, calls = streamed(client, {name: lambda **params: "sent"})
+
+    assert calls == [(name, False)]
+    [result] = tool_results(chatbot)
+    assert result["content"].endswith("sent")
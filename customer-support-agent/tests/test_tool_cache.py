@@ -0,0 +1,39 @@
+import asyncio
+import threading
+import time
+
+from tool_cache import ToolCache
+
+
+def test_entry_read_from_sqlite_keeps_its_expiry(tmp_path):
+    path = tmp_path / "tools.sqlite"
+    writer = ToolCache({"search": (1.0, 10)}, path=path)
+    writer.set("search", "q", "result")
+
+    time.sleep(0.6)
+    reader = ToolCache({"search": (1.0, 10)}, path=path)
+    assert reader.get("search", "q") == (True, "result")
+
+    time.sleep(0.6)
+    assert reader.get("search", "q") == (False, None)
+
+
+def test_async_wrapper_uses_sqlite_off_the_event_loop(tmp_path):
+    cache = ToolCache({"search": (60, 10)}, path=tmp_path / "tools.sqlite")
+    threads = []
+    for method in ("get", "set"):
+        original = getattr(cache.store, method)
+
+        def recorded(*args, original=original):
+            threads.append(threading.current_thread())
+            return original(*args)
+
+        setattr(cache.store, method, recorded)
+
+    async def search(q):
+        return f"results for {q}"
+
+    cached = cache.wrap_async("search", search)
+    assert asyncio.run(cached(q="cover")) == "results for cover"
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
@@ -0,0 +1,78 @@
+from chatbot import ChatBot, SessionState
+from config import CACHE_BREAKPOINT
+from stub_model import StubAnthropic
+from tool_registry import DEFAULT_REGISTRY, REQUEST_TOOLS
+
+# a search has already run, and the customer asks for a quote without their vehicle's details
+HISTORY = [
+    {"role": "user", "content": "What does your car insurance cover?"},
+    {
+        "role": "assistant",
+        "content": [
+            {"type": "text", "text": "Let me look that up for you."},
+            {"type": "tool_use", "id": "toolu_1", "name": "search", "input": {"q": "cover"}},
+        ],
+    },
+    {
+        "role": "user",
+        "content": [
+            {"type": "tool_result", "tool_use_id": "toolu_1", "content": "Results from search: ..."}
+        ],
+    },
+    {"role": "assistant", "content": "Acme covers liability, collision and comprehensive."},
+    {"role": "user", "content": "Can I get a quote?"},
+]
+
+
+def names(schemas):
+    return [schema["name"] for schema in schemas]
+
+
+def test_tools_are_selected_once_the_conversation_has_use_for_them():
+    def asking(text):
+        return [{"role": "user", "content": text}]
+
+    assert DEFAULT_REGISTRY.select(asking("Hi")) == ["search", "call_manager"]
+    assert "get_quote" in DEFAULT_REGISTRY.select(asking("I drive a 2019 Civic"))
+    assert "get_quote" in DEFAULT_REGISTRY.select(asking("about 30k miles"))
+    assert "send_email" in DEFAULT_REGISTRY.select(asking("my email is jane@example.com"))
+
+
+def test_a_tool_called_before_stays_selected():
+    called = [
+        {"role": "user", "content": "Hi"},
+        {
+            "role": "assistant",
+            "content": [{"type": "tool_use", "id": "toolu_1", "name": "get_quote", "input": {}}],
+        },
+    ]
+    assert "get_quote" in DEFAULT_REGISTRY.select(called)
+
+
+def test_request_tools_offers_the_tools_left_out():
+    schemas = DEFAULT_REGISTRY.schemas(["search"], cache=True)
+    assert names(schemas) == ["search", REQUEST_TOOLS]
+    items = schemas[-1]["input_schema"]["properties"]["tools"]["items"]
+    assert items["enum"] == ["get_quote", "send_email", "call_manager"]
+    assert schemas[-1]["cache_control"] == CACHE_BREAKPOINT
+    assert REQUEST_TOOLS not in names(DEFAULT_REGISTRY.schemas())
+
+
+def test_requested_tools_are_sent_on_a_second_request():
+    client = StubAnthropic()
+    requests = []
+    create = client.messages.create
+
+    def recorded(**params):
+        requests.append(params)
+        return create(**params)
+
+    client.messages.create = recorded
+    chatbot = ChatBot(SessionState(), client=client, tool_registry=DEFAULT_REGISTRY)
+    response = chatbot.generate_message(HISTORY, 2048)
+
+    assert [block.name for block in response.content if block.type == "tool_use"] == ["get_quote"]
+    assert names(requests[0]["tools"]) == ["search", "call_manager", REQUEST_TOOLS]
+    assert requests[1]["tools"] is chatbot.tools
+    # the request that asked for the tools is billed too
+    assert chatbot.usage.requests == 2
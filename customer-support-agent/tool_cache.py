@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Caches the results of deterministic tools such as `get_quote` and `search`.
+
+Entries live in an in-process LRU and, optionally, in a SQLite file that
+separate simulation processes can share. Each tool has its own time-to-live and
+size limit; tools with side effects are never cached. An entry read from SQLite
+keeps the expiry it was stored with.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from config import SIDE_EFFECTING_TOOLS, TOOL_CACHE_POLICIES
+
+
+def normalize_args(params):
+    """Returns a canonical key, so trivially different calls share an entry"""
+
+    def normalize(value):
+        if isinstance(value, str):
+            value = " ".join(value.split()).casefold()
+            if value.isdigit():
+                return int(value)
+        elif isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    return json.dumps({name: normalize(value) for name, value in params.items()}, sort_keys=True)
+
+
+class SQLiteStore:
+    """Shared on-disk entries, safe to use from several processes at once"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tool_cache ("
+            " tool TEXT, key TEXT, value TEXT, expires_at REAL, accessed_at REAL,"
+            " PRIMARY KEY (tool, key))"
+        )
+
+    def get(self, tool, key):
+        """Returns whether there's a live entry, its value and the seconds it has left"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, expires_at FROM tool_cache"
+                " WHERE tool = ? AND key = ? AND expires_at > ?",
+                (tool, key, now),
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    "UPDATE tool_cache SET accessed_at = ? WHERE tool = ? AND key = ?",
+                    (now, tool, key),
+                )
+        if row is None:
+            return False, None, None
+        return True, json.loads(row[0]), row[1] - now
+
+    def set(self, tool, key, value, ttl, maxsize):
+        """Stores an entry and returns how many entries were evicted to make room"""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO tool_cache VALUES (?, ?, ?, ?, ?)",
+                (tool, key, json.dumps(value), now + ttl, now),
+            )
+            expired = self._db.execute(
+                "DELETE FROM tool_cache WHERE tool = ? AND expires_at <= ?", (tool, now)
+            ).rowcount
+            overflow = self._db.execute(
+                "DELETE FROM tool_cache WHERE tool = ? AND key IN ("
+                " SELECT key FROM tool_cache WHERE tool = ?"
+                " ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (tool, tool, maxsize),
+            ).rowcount
+        return expired + overflow
+
+    def close(self):
+        self._db.close()
+
+
+class ToolCache:
+    """Memoizes tool implementations according to `policies`.
+
+    `policies` maps a tool name to `(ttl_seconds, max_entries)`. Pass `path` to
+    back the in-memory LRU with a shared SQLite file.
+    """
+
+    def __init__(self, policies=TOOL_CACHE_POLICIES, path=None):
+        unsafe = SIDE_EFFECTING_TOOLS.intersection(policies)
+        if unsafe:
+            raise ValueError(f"Tools with side effects can't be cached: {sorted(unsafe)}")
+
+        self.policies = dict(policies)
+        self.store = SQLiteStore(path) if path else None
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = Counter()
+        self._entries = {name: OrderedDict() for name in self.policies}
+        self._lock = threading.Lock()
+
+    def wrap(self, name, func):
+        """Returns `func` memoized, or unchanged if `name` isn't cacheable"""
+        if name not in self.policies:
+            return func
+
+        def cached(**params):
+            key = normalize_args(params)
+            hit, value = self.get(name, key)
+            if hit:
+                return value
+
+            value = func(**params)
+            self.set(name, key, value)
+            return value
+
+        return cached
+
+    def wrap_async(self, name, func):
+        """Same as `wrap`, for a coroutine function"""
+        if name not in self.policies:
+            return func
+
+        async def cached(**params):
+            key = normalize_args(params)
+            hit, value = await self.get_async(name, key)
+            if hit:
+                return value
+
+            value = await func(**params)
+            await self.set_async(name, key, value)
+            return value
+
+        return cached
+
+    def get(self, name, key):
+        hit, value = self._get_remembered(name, key)
+        if not hit and self.store is not None:
+            hit, value = self._get_stored(name, key)
+        return self._counted(name, hit, value)
+
+    async def get_async(self, name, key):
+        """Same as `get`, reading SQLite off the event loop"""
+        hit, value = self._get_remembered(name, key)
+        if not hit and self.store is not None:
+            hit, value = await asyncio.to_thread(self._get_stored, name, key)
+        return self._counted(name, hit, value)
+
+    def set(self, name, key, value):
+        self._remember(name, key, value)
+        if self.store is not None:
+            self._store(name, key, value)
+
+    async def set_async(self, name, key, value):
+        """Same as `set`, writing SQLite off the event loop"""
+        self._remember(name, key, value)
+        if self.store is not None:
+            await asyncio.to_thread(self._store, name, key, value)
+
+    def _get_remembered(self, name, key):
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries[name]
+            entry = entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    entries.move_to_end(key)
+                    return True, value
+
+                del entries[key]
+                self.evictions[name] += 1
+        return False, None
+
+    def _get_stored(self, name, key):
+        hit, value, ttl = self.store.get(name, key)
+        if hit:
+            # only for as long as the stored entry lives, not a fresh ttl
+            self._remember(name, key, value, ttl)
+        return hit, value
+
+    def _counted(self, name, hit, value):
+        with self._lock:
+            (self.hits if hit else self.misses)[name] += 1
+        return hit, value
+
+    def _store(self, name, key, value):
+        ttl, maxsize = self.policies[name]
+        evicted = self.store.set(name, key, value, ttl, maxsize)
+        with self._lock:
+            self.evictions[name] += evicted
+
+    def _remember(self, name, key, value, ttl=None):
+        policy_ttl, maxsize = self.policies[name]
+        ttl = policy_ttl if ttl is None else min(ttl, policy_ttl)
+        with self._lock:
+            entries = self._entries[name]
+            entries[key] = (time.monotonic() + ttl, value)
+            entries.move_to_end(key)
+            while len(entries) > maxsize:
+                entries.popitem(last=False)
+                self.evictions[name] += 1
+
+    def stats(self):
+        return {
+            name: {
+                "hits": self.hits[name],
+                "misses": self.misses[name],
+                "evictions": self.evictions[name],
+                "size": len(self._entries[name]),
+            }
+            for name in self.policies
+        }
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""Sends each request only the tools the conversation has use for so far.
+
+Every tool schema is sent with every request, so each tool added is a fixed
+cost on every call. A `ToolRegistry` holds the tools as `Tool` objects, each
+with the schema from `config.TOOLS` and an optional `relevant` test on the
+conversation text, and picks per request:
+
+- tools without a `relevant` test, or whose test passes (`get_quote` only once
+  the vehicle has come up, `send_email` once email has)
+- any tool the conversation has already called, so the history stays valid
+- `request_tools`, a meta tool listing the ones left out
+
+When the model calls `request_tools`, `ChatBot` asks again with the full set,
+so a tool left out costs one extra call rather than a wrong answer. Selection
+is off unless a `ChatBot` is given a `tool_registry`, as it changes what the
+experiments measure. The registry only decides what the model is offered;
+calls still go through `ChatBot.tool_functions`.
+
+Tools come first in the prompt, so with `prompt_cache` each new tool set is a
+new cached prefix: the selection only grows within a conversation, but every
+time it does the next request writes the cache again rather than reading it,
+and conversations at different sets don't share one. Weigh the tokens saved
+against that before combining the two.
+
+`python tool_registry.py` prints the token footprint of each schema, counted
+with the SDK's offline tokenizer, which is close to the model's but not exact.
+"""
+import argparse
+import json
+import re
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from config import CACHE_BREAKPOINT, TOOLS
+
+REQUEST_TOOLS = "request_tools"
+
+# A model year, or a mileage
+VEHICLE_DETAILS = re.compile(
+    r"\b(19[5-9]\d|20[0-4]\d)\b|\bmileage\b|\b\d[\d,.]*\s*(k|miles)\b", re.IGNORECASE
+)
+EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+|\be-?mail\b", re.IGNORECASE)
+
+
+@dataclass
+class Tool:
+    schema: dict  # as in `config.TOOLS`
+    # whether the conversation text makes the tool worth sending, always if None
+    relevant: Optional[Callable[[str], bool]] = None
+
+    @property
+    def name(self):
+        return self.schema["name"]
+
+
+def _blocks(content):
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    return [block if isinstance(block, dict) else block.model_dump() for block in content]
+
+
+def conversation_text(messages):
+    """The text of every message, tool inputs and results included"""
+    parts = []
+    for message in messages:
+        for block in _blocks(message["content"]):
+            if block["type"] == "tool_use":
+                parts.append(json.dumps(block["input"]))
+            else:
+                parts.append(str(block.get("text") or block.get("content") or ""))
+    return "\n".join(parts)
+
+
+def called_tools(messages):
+    """Names of the tools the assistant has called in `messages`"""
+    return {
+        block["name"]
+        for message in messages
+        if message["role"] == "assistant"
+        for block in _blocks(message["content"])
+        if block["type"] == "tool_use"
+    }
+
+
+def requested_tools(response):
+    """Whether the model answered with a call to `request_tools`"""
+    return any(
+        block.type == "tool_use" and block.name == REQUEST_TOOLS for block in response.content
+    )
+
+
+class ToolRegistry:
+    def __init__(self, tools):
+        self.tools = {tool.name: tool for tool in tools}
+
+    def select(self, messages):
+        """Names of the tools to send with `messages`, in registry order"""
+        text = conversation_text(messages)
+        called = called_tools(messages)
+        return [
+            name
+            for name, tool in self.tools.items()
+            if tool.relevant is None or name in called or tool.relevant(text)
+        ]
+
+    def schemas(self, names=None, cache=False):
+        """The schemas of `names` (all tools by default), plus `request_tools` for the rest.
+
+        With `cache`, the last one carries the prompt cache breakpoint.
+        """
+        names = list(self.tools) if names is None else names
+        schemas = [self.tools[name].schema for name in names]
+        missing = [name for name in self.tools if name not in names]
+        if missing:
+            schemas.append(self.request_tools_schema(missing))
+        if cache:
+            schemas[-1] = {**schemas[-1], "cache_control": CACHE_BREAKPOINT}
+        return schemas
+
+    def request_tools_schema(self, missing):
+        offered = "\n".join(
+            f"- {name}: {self.tools[name].schema['description']}" for name in missing
+        )
+        return {
+            "name": REQUEST_TOOLS,
+            "description": (
+                "Makes more tools available. Call it instead of answering whenever"
+                f" you need one of these:\n{offered}"
+            ),
+            "input_schema": {
+                "type": "object",
+                "properties": {"tools": {"type": "array", "items": {"enum": missing}}},
+                "required": ["tools"],
+            },
+        }
+
+    def footprints(self, count_tokens):
+        """Tokens of each tool's schema, and of `request_tools` standing in for all of them"""
+        footprints = {
+            name: count_tokens(json.dumps(tool.schema)) for name, tool in self.tools.items()
+        }
+        footprints[REQUEST_TOOLS] = count_tokens(
+            json.dumps(self.request_tools_schema(list(self.tools)))
+        )
+        return footprints
+
+
+RELEVANCE = {
+    "get_quote": VEHICLE_DETAILS.search,
+    "send_email": EMAIL.search,
+}
+
+DEFAULT_REGISTRY = ToolRegistry(
+    Tool(schema=schema, relevant=RELEVANCE.get(schema["name"])) for schema in TOOLS
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="Tool Registry",
+        description="Prints how many tokens each tool schema adds to every request",
+    )
+    parser.parse_args()
+
+    from clients import shared_client
+
+    footprints = DEFAULT_REGISTRY.footprints(shared_client().count_tokens)
+    for name, tokens in footprints.items():
+        print(f"{name:>15} {tokens:>5}")
+    print(f"{'all tools':>15} {sum(footprints.values()) - footprints[REQUEST_TOOLS]:>5}")